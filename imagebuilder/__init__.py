@@ -15,6 +15,8 @@
 #  limitations under the License.
 #
 
+import errno
+import multiprocessing
 import os
 import shutil
 import signal
@@ -22,17 +24,34 @@ import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 from plumbum import FG, BG, local
-from plumbum.cmd import bootman, chroot, conary, cp
-from plumbum.cmd import dd, depmod, dmsetup, dracut
+from plumbum.cmd import chroot, conary, cp
+from plumbum.cmd import dd, dmsetup
 from plumbum.cmd import extlinux, kpartx, losetup, mount
 from plumbum.cmd import parted, sgdisk, sh, tar, umount
-from plumbum.cmd import echo, sqlite3
+from plumbum.cmd import dumpe2fs, e2fsck, resize2fs
 import plumbum.version
 
+from imagebuilder import archives
+from imagebuilder import cgroup
 from imagebuilder import clone
+from imagebuilder import conarydb
+from imagebuilder import executor
+from imagebuilder import export
+from imagebuilder import parttable
+from imagebuilder import tagscript
+from imagebuilder import trace
+
+# tarball compression formats and the suffixes they produce
+tarballSuffixes = {
+    'gzip': '.tar.gz',
+    'xz': '.tar.xz',
+    'zstd': '.tar.zst',
+}
 
 # use the parted codes for partition types
 DOS = 'msdos'
@@ -41,15 +60,50 @@ GPT = 'gpt'
 class ImageBuilderError(IOError):
     pass
 
+class ReapGraceExpired(Exception):
+    pass
+
+class NullResource(object):
+    # stands in for a semaphore when builds are not sharing resources
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
 class ImageBuilder(object):
+    # attributes set by build steps that later steps rely on, saved
+    # in checkpoints so that a build can be resumed
+    stateAttributes = ('image', 'errname', 'rootdir', 'size', 'fsOffset',
+                       'fsSize', 'partitioned', 'sparse', 'pageSize',
+                       'extlinuxPending', 'fsShrunk', 'kver', 'unpacked',
+                       'bootCode', 'variants', 'updateState')
 
-    def __init__(self, basedir, size, rootdev, fstype, partType=DOS, inspectFailure=False):
+    def __init__(self, basedir, size, rootdev, fstype, partType=DOS, inspectFailure=False,
+                 resources=None, tracer=None, staging=None, autoSize=None,
+                 reapGrace=2.0, tagJobs=None, layerCache=None,
+                 loopDevice=None, cgroups=None):
         self.basedir = basedir
         self.size = size
         self.rootdev = rootdev
         self.fstype = fstype
         self.partType = partType
         self.inspectFailure = inspectFailure
+        # seconds that processes left in a container get after SIGTERM
+        self.reapGrace = reapGrace
+        # concurrent tag handlers; 1 runs the tag script sequentially
+        self.tagJobs = tagJobs or multiprocessing.cpu_count()
+        # maps 'cpu' and 'io' to semaphores shared between concurrent builds
+        self.resources = resources or {}
+        self.tracer = tracer or trace.NullTracer()
+        # places commands in the cgroup of the stage they run in
+        self.cgroups = cgroups or cgroup.NullCgroup()
+        # when set, the root is built in a plain directory under staging
+        # and the filesystem is created from it without loop devices
+        self.staging = staging
+        # when set, a (unit, amount) headroom with unit '%' or 'MiB';
+        # the filesystem and image are shrunk to fit their contents
+        self.autoSize = autoSize
         self.errfd, self.errname = tempfile.mkstemp(prefix='mke.',
                                                     suffix='.log',
                                                     dir=basedir)
@@ -58,23 +112,62 @@ class ImageBuilder(object):
                                           dir=basedir)
         self.mountDevice = self.image
         self.loopDevices = []
+        # when set, a free loop device to attach the image to, rather
+        # than letting kpartx find one
+        self.loopDevice = loopDevice
         self.conaryDbMounted = False
+        self.pageSize = 4096
+        self.sparse = True
         os.close(fd)
         self.rootdir = None
+        self.executor = None
+        # byte offset and size of the root filesystem within the image
+        self.fsOffset = 0
+        self.fsSize = size * 1024 * 1024
+        self.partitioned = False
+        self.rootMounted = False
+        self.filesystemsMounted = False
+        self.extlinuxPending = False
+        self.kver = None
+        # archive -> decompressed copy in basedir, from unpackArchives
+        self.unpacked = {}
+        # when set, a layercache.LayerCache that archives are extracted
+        # into once and copied from, instead of unpacked
+        self.layerCache = layerCache
+        self.fsShrunk = False
+        # whether finishFilesystem wrote boot code to the image
+        self.bootCode = False
+        # name -> image derived from this one by deriveImage
+        self.variants = {}
+        # when updating an image built earlier, what the boot steps
+        # read before the sync; see imagebuilder/update.py
+        self.updateState = None
+
+    def resource(self, kind):
+        return self.resources.get(kind, NullResource())
 
     def removeRootdir(self):
         if self.rootdir is not None:
-            os.rmdir(self.rootdir)
+            if self.staging:
+                for dirpath, dirnames, filenames in os.walk(self.rootdir):
+                    if os.path.ismount(dirpath):
+                        self.raiseError('%s still mounted, not removing %s'
+                                        % (dirpath, self.rootdir))
+                shutil.rmtree(self.rootdir)
+            else:
+                os.rmdir(self.rootdir)
 
     def cleanUp(self):
         if self.inspectFailure:
             # give the user a chance to investigate the problem first
             self.rootShell()
-        for cleanup in (self.unmountConarydb,
+        for cleanup in (self.stopExecutor,
+                        self.unmountConarydb,
                         self.unmountFilesystems,
                         self.unmountFilesystem,
                         self.unloopImage,
-                        self.removeRootdir):
+                        self.removeRootdir,
+                        self.removeUnpacked):
             try:
                 cleanup()
             except:
@@ -86,68 +179,178 @@ class ImageBuilder(object):
         sys.stderr.write(''.join(file(self.errname).readlines()[-10:]))
         raise ImageBuilderError, message
 
-    def clone(self, cmd):
-        retcode = 0
-
-        pid = clone.clone(signal.SIGCHLD|clone.CLONE_NEWPID)
-        if pid < 0:
-            self.raiseError('clone failed')
+    def reapAll(self, reaped):
+        # as init of the container, wait for every process in it;
+        # orphans are reparented to us, so ECHILD means it is empty
+        while True:
+            try:
+                os.waitpid(-1, 0)
+                reaped[0] += 1
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                if e.errno != errno.EINTR:
+                    raise
 
-        if pid == 0:
-            pid = clone.getpid()
-            if pid != 1:
-                os.write(self.errfd, 'CONTAINER FAILED: pid %d !== 1\n' %(pid))
-                os._exit(retcode)
+    def reapCommand(self, proc):
+        # wait for proc as the container init, reaping orphaned
+        # processes as they exit so that they do not accumulate;
+        # returns the exit code and the resource usage of proc
+        while True:
+            try:
+                pid, status, usage = os.wait4(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == proc.pid:
+                break
+        if os.WIFEXITED(status):
+            retcode = os.WEXITSTATUS(status)
+        else:
+            retcode = 128 + os.WTERMSIG(status)
+        if retcode:
+            os.write(self.errfd, 'ERROR exit code from contained command\n')
+        return retcode, usage
 
+    def reapStragglers(self):
+        try:
+            os.kill(-1, signal.SIGTERM)
+        except OSError:
+            # no processes to kill
+            return
+        os.write(self.errfd, '%d SIGTERM\n' % (clone.getpid()))
+        terminated = [0]
+        killed = [0]
+        def graceExpired(signum, frame):
+            raise ReapGraceExpired()
+        signal.signal(signal.SIGALRM, graceExpired)
+        signal.setitimer(signal.ITIMER_REAL, self.reapGrace)
+        try:
             try:
-                os.write(self.errfd, 'CONTAINED COMMAND: "%s"\n' % (str(cmd)))
-                sys.stdout.write(str(cmd) + '\n')
-                sys.stdout.flush()
-                cmd(stdout=None, stderr=self.errfd)
-            except:
-                os.write(self.errfd, 'ERROR exit code from contained command\n')
-                retcode = 1
+                self.reapAll(terminated)
             finally:
-                os.write(self.errfd, '%d SIGTERM\n' % (clone.getpid()))
-                try:
-                    os.kill(-1, signal.SIGTERM)
-                except OSError:
-                    # no processes to kill
-                    os._exit(retcode)
-                # kill succeeded, must have been children to kill.
-                # Sleep long enough to give them time to clean up.
-                time.sleep(2)
-                # If the child processes do not die in reasonable time
-                # from SIGTERM, kill them with SIGKILL.
-                os.write(self.errfd, '%d sending SIGKILL...\n' % (clone.getpid()))
-                try:
-                    os.kill(-1, signal.SIGKILL)
-                    os.write(self.errfd, 'some processes remained to SIGKILL\n')
-                except:
-                    # Yay, they cleaned up
-                    os.write(self.errfd, 'all processes properly terminated\n')
-                # as long as they are dead, the real init can reap them later
-                os._exit(retcode)
-
-        os.write(self.errfd, '%d WAITING for %d...\n' % (clone.getpid(), pid))
-        pid, status = os.waitpid(pid, 0)
-        os.write(self.errfd, '%d terminated with exit status %d\n' % (
-            pid, os.WEXITSTATUS(status)))
-        if not os.WIFEXITED(status):
-            self.raiseError('container %d killed' %(pid))
-        if os.WEXITSTATUS(status) != 0:
-            self.raiseError('contained command failed')
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except ReapGraceExpired:
+            # If the child processes do not die in reasonable time
+            # from SIGTERM, kill them with SIGKILL.
+            os.write(self.errfd, '%d sending SIGKILL...\n' % (clone.getpid()))
+            try:
+                os.kill(-1, signal.SIGKILL)
+            except OSError:
+                pass
+            self.reapAll(killed)
+        report = '%d stragglers terminated, %d killed\n' % (
+            terminated[0], killed[0])
+        os.write(self.errfd, report)
+        if killed[0]:
+            sys.stdout.write(report)
+            sys.stdout.flush()
 
     def run(self, cmd, fg=False):
         os.write(self.errfd, 'RUNNING COMMAND: "%s"\n' % str(cmd))
         sys.stdout.write(str(cmd) + '\n')
         sys.stdout.flush()
-        if fg:
-            result = cmd(stdout=None, stderr=self.errfd)
-        else:
-            result = cmd(stderr=self.errfd)
+        with self.tracer.command(cmd):
+            if fg:
+                result = cmd(stdout=None, stderr=self.errfd,
+                             **self.cgroups.popenArgs())
+            else:
+                result = cmd(stderr=self.errfd, **self.cgroups.popenArgs())
         return result
 
+    def runInRoot(self, argv, fg=False):
+        # runs argv inside the image through the chroot executor,
+        # which is started once and shared by all such commands
+        self.runInRootBatch([argv], fg)
+
+    def runInRootBatch(self, commands, fg=False):
+        if self.executor is None:
+            self.executor = executor.ChrootExecutor(self)
+            self.executor.start()
+        for argv in commands:
+            os.write(self.errfd, 'CHROOT COMMAND: "%s"\n' % ' '.join(argv))
+            sys.stdout.write(' '.join(argv) + '\n')
+        sys.stdout.flush()
+        results = self.executor.runBatch(commands, fg)
+        self.traceResults(commands, results)
+        for argv, result in zip(commands, results):
+            os.write(self.errfd, 'CHROOT RESULT %s: %.2fs (%.2fs user, '
+                     '%.2fs system) "%s"\n' % (result['status'],
+                     result['seconds'], result['user'], result['system'],
+                     ' '.join(argv)))
+        for argv, result in zip(commands, results):
+            if result['status'] != 0:
+                self.raiseError('command failed in image with status %s:'
+                                ' "%s"' % (result['status'], ' '.join(argv)))
+        return results
+
+    def traceResults(self, commands, results, category='command',
+                     names=None, jobs=None, fields=None):
+        # commands in the image are reaped by the chroot executor, so
+        # RUSAGE_CHILDREN and /proc/self/io do not include them until it
+        # exits; record what the executor measured for each instead
+        lane = None
+        thread = threading.current_thread()
+        if not isinstance(thread, threading._MainThread):
+            lane = thread.name
+        for index, (argv, result) in enumerate(zip(commands, results)):
+            if result['status'] is None:
+                # skipped after an earlier command in its batch failed
+                continue
+            name = 'chroot %s' % ' '.join(argv)
+            if names is not None:
+                name = names[index]
+            if jobs is not None:
+                # concurrent commands overlap, so each slot gets a lane
+                lane = '%s-%d' % (category, index % jobs)
+            extra = {}
+            if fields is not None:
+                extra = fields[index]
+            self.tracer.add(category, name, result['start'], result['seconds'],
+                            result['status'] == 0 and 'ok' or 'failed',
+                            lane=lane, childUser=result['user'],
+                            childSystem=result['system'],
+                            childMaxRss=result['maxRss'],
+                            readBytes=result['readBytes'],
+                            writeBytes=result['writeBytes'], **extra)
+
+    def runInRootParallel(self, commands, jobs, fg=False, category='command',
+                          names=None, fields=None):
+        # all commands run even if some fail; raises afterwards.
+        # category, names and fields are passed to traceResults
+        if self.executor is None:
+            self.executor = executor.ChrootExecutor(self)
+            self.executor.start()
+        for argv in commands:
+            os.write(self.errfd, 'CHROOT COMMAND: "%s"\n' % ' '.join(argv))
+        sys.stdout.write('%d commands, %d at a time\n' % (len(commands), jobs))
+        sys.stdout.flush()
+        start = time.time()
+        results = self.executor.runParallel(commands, jobs, fg)
+        self.traceResults(commands, results, category, names, jobs, fields)
+        for argv, result in zip(commands, results):
+            os.write(self.errfd, 'CHROOT RESULT %s: %.2fs (%.2fs user, '
+                     '%.2fs system) "%s"\n' % (result['status'],
+                     result['seconds'], result['user'], result['system'],
+                     ' '.join(argv)))
+        failed = [(argv, result) for argv, result in zip(commands, results)
+                  if result['status'] != 0]
+        for argv, result in failed:
+            os.write(self.errfd, 'command failed in image with status %s:'
+                     ' "%s"\n' % (result['status'], ' '.join(argv)))
+        if failed:
+            self.raiseError('%d of %d commands failed in image' % (
+                len(failed), len(commands)))
+        os.write(self.errfd, 'CHROOT PARALLEL: %d commands in %.2fs\n' % (
+            len(commands), time.time() - start))
+        return results
+
+    def stopExecutor(self):
+        if self.executor is not None:
+            self.executor.stop()
+            self.executor = None
+
     def rootShell(self):
         # does not call run() to avoid adding an "interactive" mode to run()
         try:
@@ -157,14 +360,78 @@ class ImageBuilder(object):
             sys.stdout.flush()
 
     def allocateImage(self, sparse=True):
+        self.sparse = sparse
         if sparse:
             self.run(dd['if=/dev/zero', 'of=%s'%self.image, 'bs=1M',
                 'seek=%d' %(self.size), 'count=0', ])
         else:
-            self.run(dd['if=/dev/zero', 'of=%s'%self.image, 'bs=1M',
-                'count=%d' %self.size, ])
+            # allocate blocks without writing zeros through the page cache
+            fd = os.open(self.image, os.O_WRONLY)
+            try:
+                clone.libc.fallocate(fd, 0, 0, self.size * 1024 * 1024)
+            finally:
+                os.close(fd)
 
-    def partitionImage(self, size):
+    def adoptImage(self, path, size=None, sparse=True):
+        # start from a copy of an image built earlier instead of an
+        # empty one, sharing its blocks where the filesystem supports
+        # reflinks, and enlarge it to size MiB to make room for updates
+        self.sparse = sparse
+        with self.resource('io'):
+            self.run(cp['--reflink=auto', '--sparse=always', path,
+                        self.image])
+        mib = 1024 * 1024
+        self.size = os.path.getsize(self.image) / mib
+        layout = parttable.readLayout(self.image)
+        if layout is None:
+            self.fsSize = self.size * mib
+        else:
+            gpt, firstsector, lastsector = layout
+            self.partitioned = True
+            self.partType = gpt and GPT or DOS
+            self.fsOffset = firstsector * 512
+            self.fsSize = (lastsector - firstsector + 1) * 512
+            f = file(self.image, 'rb')
+            self.bootCode = parttable.readBootCode(f).strip('\0') != ''
+            f.close()
+        if size is None or size <= self.size:
+            return
+        f = file(self.image, 'r+b')
+        f.truncate(size * mib)
+        if not sparse:
+            clone.libc.fallocate(f.fileno(), 0, 0, size * mib)
+        f.close()
+        self.size = size
+        if self.partitioned:
+            firstsector, lastsector, sectors = self.partitionLayout(size)
+            self.writePartitionTable(size)
+            self.fsSize = (lastsector - firstsector + 1) * 512
+        else:
+            self.fsSize = size * mib
+
+    def filesystemBytes(self, device):
+        fields = dict(x.split(':', 1) for x in
+                      self.run(dumpe2fs['-h', device]).split('\n')
+                      if ':' in x)
+        return int(fields['Block count']) * int(fields['Block size'])
+
+    def growFilesystem(self):
+        # fill the space adoptImage added; resize2fs requires a checked
+        # filesystem when it is not mounted
+        if self.filesystemBytes(self.mountDevice) >= self.fsSize:
+            return
+        self.run(e2fsck['-f', '-y', self.mountDevice])
+        self.run(resize2fs[self.mountDevice])
+
+    def trimFilesystem(self):
+        # discard the blocks an update freed, so that they read as zeros
+        # and become holes in the image file; shrinkFilesystem also does
+        # this when the filesystem is shrunk
+        if self.fsShrunk:
+            return
+        self.run(e2fsck['-f', '-y', '-E', 'discard', self.mountDevice])
+
+    def partitionLayout(self, size):
         sectors = size * 2048
         firstsector = 2048 # use fdisk default of reserving 1MB
         if self.partType == DOS:
@@ -174,6 +441,23 @@ class ImageBuilder(object):
             # partition table copy at the end of the disk.  Leave room
             # for a full default 64K stride for now
             lastsector = sectors - 127
+        return firstsector, lastsector, sectors
+
+    def writePartitionTable(self, size):
+        firstsector, lastsector, sectors = self.partitionLayout(size)
+        if self.partType == GPT:
+            parttable.writeGpt(self.image, firstsector, lastsector, sectors)
+        else:
+            parttable.writeDos(self.image, firstsector, lastsector)
+
+    def partitionImage(self, size):
+        firstsector, lastsector, sectors = self.partitionLayout(size)
+        self.partitioned = True
+        self.fsOffset = firstsector * 512
+        self.fsSize = (lastsector - firstsector + 1) * 512
+        if self.staging:
+            self.writePartitionTable(size)
+            return
         self.run(parted['--script', self.image,
             'unit', 's',
             'mklabel', self.partType,
@@ -185,15 +469,100 @@ class ImageBuilder(object):
             self.run(sgdisk[self.image, '--attributes=1:set:2'])
 
     def loopImage(self):
-        lines = self.run(kpartx['-a', '-v', self.image]).split('\n')
+        image = self.image
+        if self.loopDevice is not None:
+            try:
+                self.run(losetup[self.loopDevice, self.image])
+                image = self.loopDevice
+            except Exception:
+                # taken by something else since it was set aside
+                pass
+        lines = self.run(kpartx['-a', '-v', image]).split('\n')
         if lines:
             self.mountDevice = '/dev/mapper/%s' %(
                 [x.split()[2] for x in lines if x][0])
             self.loopDevices.append(self.mountDevice)
 
     def createFilesystem(self):
+        if self.staging:
+            # created from the populated root by populateFilesystem
+            return
         return self.run(local['mkfs.%s' %self.fstype]['-F', '-L', '/', self.mountDevice])
 
+    def populateFilesystem(self):
+        # create the filesystem in place within the image file in one
+        # pass from the staged root, at the partition offset if any
+        if self.autoSize and self.fsOffset:
+            # resize2fs cannot work at an offset, so build and shrink
+            # the filesystem in its own file and then splice it in
+            fsImage = self.image + '.fs'
+            self.run(dd['if=/dev/zero', 'of=%s' % fsImage, 'bs=1M',
+                'seek=%d' %(self.fsSize / (1024 * 1024)), 'count=0', ])
+            try:
+                self.run(local['mkfs.%s' %self.fstype]['-F', '-L', '/',
+                    '-d', self.rootdir, fsImage])
+                self.shrinkFilesystem(fsImage)
+                self.run(dd['if=%s' % fsImage, 'of=%s' % self.image,
+                    'bs=1M', 'seek=%d' %(self.fsOffset / (1024 * 1024)),
+                    'conv=sparse,notrunc'])
+            finally:
+                os.unlink(fsImage)
+            return
+        self.run(local['mkfs.%s' %self.fstype]['-F', '-L', '/',
+            '-d', self.rootdir,
+            '-E', 'offset=%d' % self.fsOffset,
+            self.image, '%dk' % (self.fsSize / 1024)])
+        if self.autoSize:
+            self.shrinkFilesystem(self.image)
+
+    def shrinkFilesystem(self, device=None):
+        # shrink the unmounted filesystem to its minimum size plus
+        # headroom, and discard the free blocks so that they read as
+        # zeros and become holes in the image file
+        if not self.autoSize or self.fsShrunk:
+            return
+        if device is None:
+            device = self.mountDevice
+        self.run(e2fsck['-f', '-y', device])
+        minimum = int(self.run(resize2fs['-P', device]).strip().split(':')[-1])
+        blockSize = [int(x.split(':')[1]) for x in
+                     self.run(dumpe2fs['-h', device]).split('\n')
+                     if x.startswith('Block size:')][0]
+        size = minimum * blockSize
+        unit, amount = self.autoSize
+        if unit == '%':
+            size += size * amount / 100
+        else:
+            size += amount * 1024 * 1024
+        # whole MiB, to keep the partition and image aligned
+        mib = 1024 * 1024
+        size = (size + mib - 1) / mib * mib
+        if size < self.fsSize:
+            self.run(resize2fs[device, '%dK' % (size / 1024)])
+            self.fsSize = size
+        self.run(e2fsck['-f', '-y', '-E', 'discard', device])
+        self.fsShrunk = True
+        if self.extlinuxPending and not self.staging:
+            # staged filesystems get extlinux once spliced into the image
+            self.installExtlinux()
+
+    def resizeImage(self):
+        # cut the image file down to the shrunken filesystem, after
+        # the image is no longer looped
+        if not self.fsShrunk:
+            return
+        mib = 1024 * 1024
+        size = (self.fsOffset + self.fsSize) / mib
+        if self.partitioned:
+            if self.partType == GPT:
+                # room for the backup GPT
+                size += 1
+            self.writePartitionTable(size)
+        f = file(self.image, 'r+b')
+        f.truncate(size * mib)
+        f.close()
+        self.size = size
+
     def unloopImage(self):
         if self.loopDevices:
             self.run(kpartx['-d', self.image])
@@ -207,13 +576,49 @@ class ImageBuilder(object):
                 backing = '/sys/block/' + dev + '/loop/backing_file'
                 if os.path.exists(backing):
                     self.run(losetup['-d', base])
+            self.loopDevices = []
+            self.mountDevice = self.image
 
     def mountFilesystem(self):
+        if self.staging:
+            self.rootdir = tempfile.mkdtemp(prefix='mkd.', dir=self.staging)
+            os.chmod(self.rootdir, 0755)
+            return
         self.rootdir = tempfile.mkdtemp(prefix='mkd.', dir=self.basedir)
+        self.mountRoot()
+
+    def mountRoot(self):
         self.run(mount[self.mountDevice, '-o', 'barrier=0,data=writeback', '-t', self.fstype, self.rootdir])
-        
+        self.rootMounted = True
+
     def unmountFilesystem(self):
+        if self.staging:
+            return
         self.run(umount[self.rootdir])
+        self.rootMounted = False
+
+    def installExtlinux(self):
+        self.extlinuxPending = False
+        if self.rootMounted:
+            self.run(extlinux['-i', self.rootdir + '/boot/extlinux'])
+            return
+        # extlinux can only be installed into a mounted filesystem, so
+        # briefly mount the finished filesystem
+        mountPoint = tempfile.mkdtemp(prefix='mkx.', dir=self.basedir)
+        try:
+            if self.staging:
+                self.run(mount['-o', 'loop,offset=%d,sizelimit=%d' %(
+                                   self.fsOffset, self.fsSize),
+                               '-t', self.fstype, self.image, mountPoint])
+            else:
+                self.run(mount['-t', self.fstype, self.mountDevice,
+                               mountPoint])
+            try:
+                self.run(extlinux['-i', mountPoint + '/boot/extlinux'])
+            finally:
+                self.run(umount[mountPoint])
+        finally:
+            os.rmdir(mountPoint)
 
     def prepareFilesystem(self, modelFile):
         os.mkdir(self.rootdir + '/dev', 0755)
@@ -247,7 +652,16 @@ class ImageBuilder(object):
         if modelFile:
             file(self.rootdir + '/etc/conary/system-model', 'w+').write(
                 file(modelFile).read())
+        self.mountFilesystems()
+
+    def prepareUpdate(self, modelFile):
+        # an image built earlier has its directories and device nodes
+        if modelFile:
+            file(self.rootdir + '/etc/conary/system-model', 'w').write(
+                file(modelFile).read())
+        self.mountFilesystems()
 
+    def mountFilesystems(self):
         self.run(mount['proc', '-t', 'proc', self.rootdir + '/proc'])
         self.run(mount['devpts', '-t', 'devpts',
                       self.rootdir + '/dev/pts', '-o', 'gid=5,mode=620'])
@@ -259,6 +673,7 @@ class ImageBuilder(object):
         os.chmod(self.rootdir + '/dev/shm', 01777)
         os.chmod(self.rootdir + '/dev/pts', 0755)
         os.chmod(self.rootdir + '/tmp', 01777)
+        self.filesystemsMounted = True
 
     def mountConarydb(self):
         # speed up database by not waiting for disk
@@ -267,10 +682,36 @@ class ImageBuilder(object):
         self.conaryDbMounted = True
 
     def tuneConarydb(self, pageSize=4096, defaultCacheSize=2000):
-        self.run(echo['pragma default_cache_size=%d; '
-                      'pragma page_size=%d; '
-                      'vacuum;' % (defaultCacheSize, pageSize)]
-                 | sqlite3[self.rootdir + '/var/lib/conarydb/conarydb'])
+        self.pageSize = pageSize
+        with self.tracer.span('conarydb', 'tune'):
+            conarydb.tune(self.rootdir + '/var/lib/conarydb/conarydb',
+                          pageSize, defaultCacheSize)
+
+    def copyConarydb(self, source, destination):
+        steps = []
+        database = source + '/conarydb'
+        if os.path.exists(database):
+            with self.tracer.span('conarydb', 'copy database'):
+                steps.extend(conarydb.copy(database,
+                                           destination + '/conarydb',
+                                           self.pageSize))
+            st = os.stat(database)
+            os.chown(destination + '/conarydb', st.st_uid, st.st_gid)
+            os.chmod(destination + '/conarydb', stat.S_IMODE(st.st_mode))
+        # the database is rebuilt, so any journal is obsolete
+        others = [source + '/' + x for x in os.listdir(source)
+                  if x not in ('conarydb', 'conarydb-journal',
+                               'conarydb-wal', 'conarydb-shm')]
+        if others:
+            start = time.time()
+            self.run(cp[('-a',) + tuple(others) + (destination + '/',)])
+            steps.append(('copy %d files' % len(others), time.time() - start,
+                          sum(os.lstat(x).st_size for x in others)))
+        for step, seconds, size in steps:
+            report = 'conarydb %s: %.2fs, %d bytes\n' % (step, seconds, size)
+            os.write(self.errfd, report)
+            sys.stdout.write(report)
+        sys.stdout.flush()
 
     def writePostConfig(self, timezone, lang, keytable):
         configFiles = [
@@ -310,6 +751,9 @@ class ImageBuilder(object):
             self.raiseError('specified zoneinfo file %s missing' % tzFile)
 
     def finishFilesystem(self):
+        # no more commands run in the image
+        self.stopExecutor()
+
         mbr = None
         if self.partType == GPT:
             mbrPath = self.rootdir + '/boot/extlinux/gptmbr.bin'
@@ -318,24 +762,21 @@ class ImageBuilder(object):
         if os.path.exists(mbrPath):
             mbr = file(mbrPath).read()
 
-            self.run(extlinux['-i', self.rootdir + '/boot/extlinux'])
-
-        if self.conaryDbMounted:
-            # copy conary database from tmpfs to image
-            os.mkdir(self.rootdir + '/var/lib/conarydb.real', 0755)
-            conarydbFiles = [self.rootdir + '/var/lib/conarydb/' + x
-                             for x in os.listdir(self.rootdir
-                                                 + '/var/lib/conarydb')]
-            for conaryFile in conarydbFiles:
-                self.run(cp['-a',
-                                conaryFile,
-                                self.rootdir + '/var/lib/conarydb.real/'])
-            self.unmountConarydb()
-            os.rename(self.rootdir + '/var/lib/conarydb.real',
-                      self.rootdir + '/var/lib/conarydb')
+            if self.staging or self.autoSize:
+                # resize2fs may move the blocks extlinux points at,
+                # so install it after the filesystem is final
+                self.extlinuxPending = True
+            else:
+                self.installExtlinux()
 
+        self.saveConarydb()
         self.unmountFilesystems()
 
+        if self.staging:
+            self.populateFilesystem()
+            if self.extlinuxPending:
+                self.installExtlinux()
+
         if mbr:
             f = os.open(self.image, os.O_WRONLY)
             l = os.write(f, mbr)
@@ -343,9 +784,51 @@ class ImageBuilder(object):
             if l != len(mbr):
                 self.raiseError('failed to write full MBR: wrote %d of %d bytes'
                                 % (l, len(mbr)))
+            self.bootCode = True
+
+    def deriveImage(self, name):
+        # an unpartitioned image holding a copy of the finished
+        # filesystem, so that one population can be shipped as several
+        # image types.  As when building an unpartitioned image, the
+        # boot code is written over the start of the filesystem; when
+        # this image is partitioned, that start still holds the boot
+        # sector extlinux installed, so derive from partitioned images.
+        if name in self.variants and os.path.exists(self.variants[name]):
+            os.unlink(self.variants[name])
+        fd, image = tempfile.mkstemp(prefix='mki.', suffix='.img',
+                                     dir=self.basedir)
+        os.close(fd)
+        self.variants[name] = image
+        os.write(self.errfd, 'DERIVING %s image %s from %s\n' % (
+            name, image, self.image))
+        with self.resource('io'):
+            with self.tracer.command('derive %s' % image):
+                f = file(image, 'r+b')
+                f.truncate(self.fsSize)
+                if not self.sparse:
+                    clone.libc.fallocate(f.fileno(), 0, 0, self.fsSize)
+                f.close()
+                export.copyRange(self.image, self.fsOffset, image, 0,
+                                 self.fsSize)
+                if self.partitioned and self.bootCode:
+                    export.copyRange(self.image, 0, image, 0, 440)
+        return image
+
+    def saveConarydb(self):
+        if not self.conaryDbMounted:
+            return
+        # copy conary database from tmpfs to image
+        os.mkdir(self.rootdir + '/var/lib/conarydb.real', 0755)
+        with self.resource('io'):
+            self.copyConarydb(self.rootdir + '/var/lib/conarydb',
+                              self.rootdir + '/var/lib/conarydb.real')
+        self.unmountConarydb()
+        os.rename(self.rootdir + '/var/lib/conarydb.real',
+                  self.rootdir + '/var/lib/conarydb')
 
     def unmountConarydb(self):
         self.run(umount[self.rootdir + '/var/lib/conarydb'])
+        self.conaryDbMounted = False
 
     def unmountFilesystems(self):
         self.run(umount[self.rootdir + '/proc'])
@@ -354,53 +837,279 @@ class ImageBuilder(object):
         self.run(umount[self.rootdir + '/dev/shm'])
         self.run(umount[self.rootdir + '/var/tmp'])
         self.run(umount[self.rootdir + '/tmp'])
+        self.filesystemsMounted = False
+
+    def saveState(self):
+        return dict((x, getattr(self, x)) for x in self.stateAttributes)
+
+    def liveState(self):
+        # what is looped and mounted between build steps
+        return {
+            'looped': bool(self.loopDevices),
+            'mounted': self.rootMounted,
+            'filesystems': self.filesystemsMounted,
+        }
+
+    def suspend(self, saveDir):
+        # tear down a failed build but keep the partial image and root
+        # so that it can be resumed.  The contents of tmpfs mounts are
+        # kept in saveDir, and the conary database is moved to disk.
+        if self.inspectFailure:
+            self.rootShell()
+        self.stopExecutor()
+        if self.filesystemsMounted:
+            self.saveConarydb()
+            for path in ('/tmp', '/var/tmp'):
+                saved = saveDir + path
+                if os.path.exists(saved):
+                    shutil.rmtree(saved)
+                os.makedirs(saved)
+                self.run(cp['-a', self.rootdir + path + '/.', saved])
+            self.unmountFilesystems()
+        if self.rootMounted:
+            self.unmountFilesystem()
+        self.unloopImage()
+
+    def resume(self, state, live, saveDir):
+        # adopt the image, root and log of a suspended build and loop
+        # and mount them as they were after its last completed step
+        os.close(self.errfd)
+        os.unlink(self.errname)
+        os.unlink(self.image)
+        for name in self.stateAttributes:
+            setattr(self, name, state[name])
+        self.errfd = os.open(self.errname,
+                             os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0600)
+        self.mountDevice = self.image
+        os.write(self.errfd, 'RESUMING build of %s\n' % self.image)
+        if live['looped']:
+            self.loopImage()
+        if live['mounted']:
+            self.mountRoot()
+        if live['filesystems']:
+            self.mountFilesystems()
+            for path in ('/tmp', '/var/tmp'):
+                saved = saveDir + path
+                if os.path.exists(saved):
+                    self.run(cp['-a', saved + '/.', self.rootdir + path])
+
+    def discard(self, state):
+        # remove the partial image and root of a suspended build
+        rootdir = state['rootdir']
+        if rootdir is not None and os.path.isdir(rootdir):
+            for dirpath, dirnames, filenames in os.walk(rootdir):
+                if os.path.ismount(dirpath):
+                    self.raiseError('%s still mounted, not removing %s'
+                                    % (dirpath, rootdir))
+            shutil.rmtree(rootdir)
+        for image in [state['image']] + state['variants'].values():
+            if os.path.exists(image):
+                os.unlink(image)
+        for path in state['unpacked'].values():
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def compressor(self, compression, level=None, threads=None):
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        if compression == 'gzip':
+            try:
+                cmd = local['pigz']['-p', '%d' % threads]
+            except Exception:
+                # single-threaded, but produces the same format
+                cmd = local['gzip']
+        elif compression == 'xz':
+            cmd = local['xz']['-T%d' % threads]
+        elif compression == 'zstd':
+            cmd = local['zstd']['-q', '-T%d' % threads]
+        else:
+            self.raiseError('unknown tarball compression %s' % compression)
+        if level is not None:
+            cmd = cmd['-%d' % level]
+        return cmd['-c']
+
+    def exportImage(self, artifacts, image=None, extra=()):
+        # artifacts is a list of (format, path); raw must be the image.
+        # extra artifact objects (such as a chunk store) are written in
+        # the same pass, but only the checksums of artifacts are returned
+        if image is None:
+            image = self.image
+        objects = []
+        for fmt, path in artifacts:
+            if fmt == 'raw':
+                objects.append(export.RawArtifact(path, punch=self.sparse))
+            else:
+                objects.append(export.artifactTypes[fmt](path))
+        os.write(self.errfd, 'EXPORTING: %s\n' % ', '.join(
+            '%s:%s' % x for x in artifacts))
+        with self.resource('io'):
+            with self.tracer.command('export %s' % image):
+                return export.exportImage(image,
+                                          objects + list(extra))[:len(objects)]
+
+    def createTarball(self, compression='gzip', level=None, threads=None,
+                      destination=None):
+        # destination may be a final path or a named pipe; otherwise
+        # a temporary file in basedir is created and returned
+        if destination is None:
+            fd, destination = tempfile.mkstemp(prefix='image.',
+                                     suffix=tarballSuffixes[compression],
+                                     dir=self.basedir)
+            os.close(fd)
+        compressor = self.compressor(compression, level, threads)
+        with self.resource('cpu'):
+            try:
+                self.run((tar['-C', self.rootdir, '-c', '-f', '-', '.']
+                          | compressor) > destination)
+            except:
+                # do not leave a truncated tarball behind
+                if os.path.isfile(destination):
+                    os.unlink(destination)
+                raise
+        return destination
 
-    def createTarball(self):
-        fd, t = tempfile.mkstemp(prefix='image.',
-                                 suffix='.tar.gz',
-                                 dir=self.basedir)
+    def decompressor(self, tarball):
+        # for the compression tarball was found to use by its contents;
+        # None for an uncompressed tarball
+        threads = multiprocessing.cpu_count()
+        compression = archives.archiveFormat(tarball)
+        if compression == 'gzip':
+            try:
+                return local['pigz']['-d', '-c']
+            except Exception:
+                return local['gzip']['-d', '-c']
+        elif compression == 'xz':
+            return local['xz']['-T%d' % threads, '-d', '-c']
+        elif compression == 'zstd':
+            return local['zstd']['-q', '-d', '-c']
+        elif compression == 'bzip2':
+            try:
+                return local['pbzip2']['-p%d' % threads, '-d', '-c']
+            except Exception:
+                return local['bzip2']['-d', '-c']
+        return None
+
+    def unpackArchive(self, tarball):
+        if self.layerCache is not None:
+            self.layerCache.layer(self, tarball)
+            return
+        decompressor = self.decompressor(tarball)
+        if tarball in self.unpacked or decompressor is None:
+            # uncompressed tarballs are extracted directly
+            return
+        fd, path = tempfile.mkstemp(prefix='mku.', suffix='.tar',
+                                    dir=self.basedir)
         os.close(fd)
-        self.run(tar['-C', self.rootdir, '-c', '-z', '-f', t, '.'])
-        return t
+        try:
+            with self.resource('cpu'):
+                self.run(decompressor[tarball] > path)
+        except:
+            os.unlink(path)
+            raise
+        self.unpacked[tarball] = path
+
+    def unpackArchives(self, images):
+        # decompress [prefix:]archive arguments ahead of time into plain
+        # tar files in basedir, so that installing them is only extraction;
+        # runs in the background while earlier steps run
+        tarballs = []
+        for image in images:
+            tarball = archives.splitImage(image)[1]
+            if tarball not in tarballs:
+                tarballs.append(tarball)
+        self.concurrently(self.unpackArchive, tarballs)
+
+    def concurrently(self, function, items):
+        # calls function on each item in threads, raising the first error
+        if len(items) < 2:
+            map(function, items)
+            return
+        pool = ThreadPool(len(items))
+        try:
+            pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def removeUnpacked(self, images=None):
+        # images are [prefix:]archive arguments; None removes all
+        tarballs = [x.split(':', 1)[-1] for x in images or ()]
+        for tarball in self.unpacked.keys():
+            if images is None or tarball in tarballs:
+                path = self.unpacked.pop(tarball)
+                if os.path.exists(path):
+                    os.unlink(path)
 
     def installTarball(self, prefix, tarball):
         basedir = self.rootdir + prefix
         if not os.path.exists(basedir):
-            os.makedirs(basedir, mode=0755)
-        self.run(tar['-C', basedir, '-x', '-z', '-f', tarball])
-
-    def installTarballWithPrefix(self, tarball):
-        prefix = '/'
-        if ':' in tarball:
-            prefix, tarball = tarball.split(':', 1)
-        self.installTarball(prefix, tarball)
+            try:
+                os.makedirs(basedir, mode=0755)
+            except OSError, e:
+                # created by an archive being installed concurrently
+                if e.errno != errno.EEXIST:
+                    raise
+        if self.layerCache is not None:
+            self.layerCache.install(self, tarball, basedir)
+            return
+        unpacked = self.unpacked.pop(tarball, None)
+        with self.resource('io'):
+            if unpacked is not None and os.path.exists(unpacked):
+                try:
+                    self.run(tar[('-C', basedir, '-x', '-f', unpacked)
+                                 + archives.extractOptions])
+                finally:
+                    os.unlink(unpacked)
+                return
+            decompressor = self.decompressor(tarball)
+            if decompressor is None:
+                self.run(tar[('-C', basedir, '-x', '-f', tarball)
+                             + archives.extractOptions])
+            else:
+                self.run(decompressor[tarball]
+                         | tar[('-C', basedir, '-x', '-f', '-')
+                               + archives.extractOptions])
 
-    def installPreImage(self, pre_image):
-        if pre_image:
-            self.installTarballWithPrefix(pre_image)
+    def installArchives(self, images):
+        # installs [prefix:]archive arguments; archives whose prefixes
+        # overlap are installed in order, and the rest concurrently
+        root = os.path.realpath(self.rootdir)
+        resolve = lambda prefix: os.path.realpath(root + '/' + prefix)
+        def settled(prefix):
+            # a directory reached without symlinks; an archive can only
+            # redirect it by being extracted above it, and so overlaps it
+            path = os.path.normpath(root + '/' + prefix)
+            return os.path.isdir(path) and resolve(prefix) == path
+        if [x for x in images if not settled(archives.splitImage(x)[0])]:
+            # an earlier archive may create a symlink or directory that
+            # the prefix leads through, so install everything in order
+            groups = [[archives.splitImage(x) for x in images]]
+        else:
+            groups = archives.groups(images, resolve)
+        self.concurrently(lambda group: [self.installTarball(*x)
+                                         for x in group], groups)
 
-    def installSystem(self):
+    def installSystem(self, changesets=()):
         # Note that system config is applied; this is generally not
         # important but may cause :supdoc noise later on (for instance).
         # This can be improved later
-        self.run(conary['sync',
-             '--no-interactive',
-             '--replace-unmanaged-files',
-             '--tag-script=%s/tmp/tag-script' %self.rootdir,
-             '--root', self.rootdir], fg=True)
+        # Troves found in the changeset files are not downloaded.
+        with self.resource('io'):
+            self.run(conary[('sync',
+                 '--no-interactive',
+                 '--replace-unmanaged-files',
+                 '--tag-script=%s/tmp/tag-script' %self.rootdir,
+                 '--root', self.rootdir) +
+                 tuple('--from-file=%s' % x for x in changesets)], fg=True)
 
-    def removeRollbacks(self):
+    def removeRollbacks(self, rollback='r.0'):
         # remove conary rollbacks to avoid rolling back to uninstalled
-        self.run(conary['rmrollback', 'r.0',
+        self.run(conary['rmrollback', rollback,
              '--no-interactive',
              '--root', self.rootdir])
 
-    def installPostImage(self, post_image):
-        if post_image:
-            self.installTarballWithPrefix(post_image)
-
-    def createBootloaderConf(self):
-        self.kver = os.listdir(self.rootdir + '/lib/modules')[0]
+    def createBootloaderConf(self, kver=None):
+        self.kver = kver or os.listdir(self.rootdir + '/lib/modules')[0]
         file(self.rootdir + '/etc/bootloader.conf', 'w').write('\n'.join((
             'read_only',
             'timeout 50',
@@ -411,12 +1120,12 @@ class ImageBuilder(object):
         )))
 
     def convertPasswords(self):
-        self.run(chroot[self.rootdir, 'pwconv'])
+        self.runInRoot(['pwconv'])
 
     def unsetRootPassword(self):
         if (not isinstance(plumbum.version, tuple)) or plumbum.version[0] < 1:
             self.raiseError('newer plumbum required to reset root password')
-        self.run(chroot[self.rootdir, 'usermod', '-p', '', 'root'])
+        self.runInRoot(['usermod', '-p', '', 'root'])
 
     def setInitlevel(self, initlevel):
         inittab = file(self.rootdir + '/etc/inittab').readlines()
@@ -429,41 +1138,75 @@ class ImageBuilder(object):
         file(self.rootdir + '/etc/inittab', 'w').write(''.join(i))
 
     def runTagScripts(self):
-        tags = file(self.rootdir + '/tmp/tag-script').read()
-        tags = tags.replace('/sbin/ldconfig\n', '')
-        tags = '/sbin/ldconfig\n' + tags
-        tags = tags.split('\n')
-        t = []
-        ignore = False
-        for tagline in tags:
-            if tagline.startswith('/usr/libexec/conary/tags/kernel files update '):
-                ignore = True
-            if tagline.startswith('/usr/libexec/conary/tags/extlinux files update '):
-                ignore = True
-            if tagline.startswith('/usr/libexec/conary/tags/udev files update '):
-                ignore = True
-            if ignore:
-                if tagline == 'EOF':
-                    ignore = False
-            else:
-                t.append(tagline)
-        t.append('')
-        tags = '\n'.join(t)
-        file(self.rootdir + '/tmp/tag-script', 'w').write(tags)
-        self.clone(chroot[self.rootdir, 'sh', '/tmp/tag-script'])
+        tags = tagscript.TagScript(
+            file(self.rootdir + '/tmp/tag-script').read())
+        # the sequential script is kept for reference
+        file(self.rootdir + '/tmp/tag-script', 'w').write(tags.script())
+        if self.tagJobs <= 1 or not [x for x in tags.handlerSteps()
+                                     if len(x) > 1]:
+            self.runInRoot(['sh', '/tmp/tag-script'], fg=True)
+            return
+
+        # plain commands in order, and between them the handlers of
+        # each run of invocations, which are independent of each
+        # other, concurrently
+        handlerDir = self.rootdir + '/tmp/tag-handlers'
+        if not os.path.exists(handlerDir):
+            os.makedirs(handlerDir)
+        with self.tracer.stage('tag handlers'):
+            for index, step in enumerate(tags.steps):
+                name = '/tmp/tag-handlers/%04d' % index
+                if isinstance(step[0], str):
+                    file(self.rootdir + name, 'w').write(
+                        '\n'.join(step + ['']))
+                    self.runInRoot(['sh', name], fg=True)
+                    continue
+                commands = []
+                for handlerIndex, handler in enumerate(step):
+                    handlerName = '%s-%04d' % (name, handlerIndex)
+                    file(self.rootdir + handlerName, 'w').write(
+                        handler.script())
+                    commands.append(['sh', handlerName])
+                results = self.runInRootParallel(
+                    commands, self.tagJobs, fg=True, category='tag',
+                    names=[x.path for x in step],
+                    fields=[{'files': x.fileCount()} for x in step])
+                for handler, result in zip(step, results):
+                    os.write(self.errfd, 'TAG HANDLER %s: %.2fs, %d files\n'
+                             % (handler.path, result['seconds'],
+                                handler.fileCount()))
 
     def runPostScript(self, command):
-        self.run(chroot[self.rootdir, 'sh', '-c', command])
+        self.runInRoot(['sh', '-c', command])
 
-    def createInitrd(self):
+    def runPostScripts(self, commands):
+        # sent to the chroot executor together; stops at first failure
+        self.runInRootBatch([['sh', '-c', x] for x in commands])
+
+    def createInitrd(self, cache=None):
         initrd = '/boot/initrd-%s' % self.kver
-        self.run(chroot[self.rootdir,
-             'depmod', '-ae', '-F', '/boot/System.map-' + self.kver, self.kver],
-             fg=True)
-        # --add-drivers raid0 raid1 raid4 raid5 raid6 raid10 ...?
-        self.run(chroot[self.rootdir,
-             'dracut', '-f', initrd, self.kver],
-             fg=True)
+        if cache is not None:
+            with self.resource('io'):
+                with self.tracer.span('initrd', 'hash'):
+                    cache.key(self.rootdir, self.kver)
+            if cache.restore(self.rootdir, self.kver):
+                sys.stdout.write('initrd cache hit %s\n' % cache.hash)
+                sys.stdout.flush()
+                return
+            before = cache.moduleState(self.rootdir, self.kver)
+        with self.resource('cpu'):
+            self.runInRoot(
+                 ['depmod', '-ae', '-F', '/boot/System.map-' + self.kver, self.kver],
+                 fg=True)
+            # --add-drivers raid0 raid1 raid4 raid5 raid6 raid10 ...?
+            self.runInRoot(
+                 ['dracut', '-f', initrd, self.kver],
+                 fg=True)
+        if cache is not None:
+            with self.resource('io'):
+                cache.store(self.rootdir, self.kver, before)
+            sys.stdout.write('initrd cache miss %s\n' % cache.hash)
+            sys.stdout.flush()
 
     def runBootman(self):
         rootConf = self.rootdir + '/etc/bootloader.d/root.conf'
@@ -474,7 +1217,7 @@ class ImageBuilder(object):
                 'root LABEL=/',
                 '')))
 
-        self.run(chroot[self.rootdir, 'bootman'])
+        self.runInRoot(['bootman'])
 
         # make images work when booted in EC2
         menuLst = self.rootdir + '/boot/grub/menu.lst'
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# detects the compression of pre-image and post-image archives from
+# their contents, and orders their extraction.  Archives are grouped
+# so that any two whose prefixes overlap (one is the other or is below
+# it) are in the same group, in the order they were given; the groups
+# touch disjoint parts of the tree, so they can be extracted
+# concurrently with the same result as extracting every archive in
+# order.
+
+import os
+
+# leading bytes of each compressed format; anything else is taken to
+# be an uncompressed tar archive
+magic = (
+    ('\x1f\x8b', 'gzip'),
+    ('\xfd7zXZ\x00', 'xz'),
+    ('\x28\xb5\x2f\xfd', 'zstd'),
+    ('BZh', 'bzip2'),
+)
+
+# ownership, modes and hardlinks are restored by tar as root; extended
+# attributes (file capabilities, security labels) have to be asked for
+extractOptions = ('--xattrs', '--xattrs-include=*')
+
+
+def archiveFormat(path):
+    header = file(path).read(6)
+    for prefix, name in magic:
+        if header.startswith(prefix):
+            return name
+    return None
+
+
+def splitImage(image):
+    # [prefix:]archive
+    prefix = '/'
+    archive = image
+    if ':' in image:
+        prefix, archive = image.split(':', 1)
+    return prefix, archive
+
+
+def overlaps(a, b):
+    a = a.rstrip('/') + '/'
+    b = b.rstrip('/') + '/'
+    return a.startswith(b) or b.startswith(a)
+
+
+def groups(images, resolve=os.path.normpath):
+    # returns lists of (prefix, archive) to install in order; the lists
+    # can be installed concurrently.  resolve maps a prefix to the path
+    # it is extracted in, so that prefixes reached through symlinks are
+    # compared by where they lead.  That is only where they lead before
+    # any of the archives is extracted; see installArchives
+    found = []
+    for index, image in enumerate(images):
+        prefix, archive = splitImage(image)
+        paths = [resolve(prefix)]
+        members = [(index, prefix, archive)]
+        for group in found[:]:
+            if [x for x in group[0] if overlaps(x, paths[0])]:
+                found.remove(group)
+                paths.extend(group[0])
+                members.extend(group[1])
+        found.append((paths, sorted(members)))
+    return [[x[1:] for x in members]
+            for paths, members in sorted(found, key=lambda x: x[1][0])]
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# builds many images described in one manifest on a bounded pool of
+# processes.  The manifest is YAML (or JSON if PyYAML is not installed):
+#
+#   workdir: /srv/images
+#   jobs: 4
+#   cpu-jobs: 2
+#   io-jobs: 2
+#   images:
+#     - basename: desktop
+#       type: rawHd
+#       size: 8000
+#       model: desktop.model
+#       post-image: [home.tar.gz]
+#       post-script: ['chkconfig sshd on']
+#
+# Each image entry takes the same long options as flimage itself, and
+# needs a basename; entries without one are reported as failed.  Each
+# image is built in its own directory (by default workdir/basename)
+# and a failure in one image does not stop the others.
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def loadManifest(path):
+    text = file(path).read()
+    if yaml is not None:
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def specArgs(spec, workdir):
+    # raises ValueError for an entry that cannot be built
+    if not isinstance(spec, dict):
+        raise ValueError('not a mapping of options')
+    if not spec.get('basename'):
+        raise ValueError('basename required')
+    spec = dict(spec)
+    if 'dir' not in spec:
+        spec['dir'] = '/'.join((workdir, spec['basename']))
+    argv = []
+    for key, value in sorted(spec.items()):
+        option = '--' + key.replace('_', '-')
+        if value is None or value is False:
+            continue
+        if value is True:
+            argv.append(option)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                argv.extend((option, str(item)))
+        else:
+            argv.extend((option, str(value)))
+    return spec['dir'], argv
+
+
+# set in each worker process by initWorker
+builder = None
+resources = None
+
+def initWorker(buildFunction, sharedResources):
+    global builder, resources
+    builder = buildFunction
+    resources = sharedResources
+
+
+def runBuild(job):
+    name, basedir, argv = job
+    start = time.time()
+    result = {'name': name, 'dir': basedir, 'status': 'ok', 'error': None}
+    try:
+        if not os.path.exists(basedir):
+            os.makedirs(basedir)
+        # each worker builds exactly one image, so there is no need
+        # to restore stdout and stderr afterwards
+        log = os.open(basedir + '/flimage.log',
+                      os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0644)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        os.close(log)
+        builder(argv, resources)
+    except SystemExit, e:
+        # argument errors in the manifest entry
+        result['status'] = 'failed'
+        result['error'] = 'invalid arguments (exit %s)' % e.code
+    except:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc().strip().split('\n')[-1]
+        sys.stderr.write(traceback.format_exc())
+    result['elapsed'] = time.time() - start
+    return result
+
+
+class BatchBuilder(object):
+    def __init__(self, buildFunction, jobs=1, cpuJobs=None, ioJobs=None):
+        self.buildFunction = buildFunction
+        self.jobs = jobs
+        self.resources = {}
+        if cpuJobs:
+            self.resources['cpu'] = multiprocessing.BoundedSemaphore(cpuJobs)
+        if ioJobs:
+            self.resources['io'] = multiprocessing.BoundedSemaphore(ioJobs)
+
+    def run(self, specs, workdir):
+        jobs = []
+        # in manifest order; None for the entries built by the pool
+        results = []
+        for index, spec in enumerate(specs):
+            try:
+                basedir, argv = specArgs(spec, workdir)
+            except ValueError, e:
+                name = 'image %d' % (index + 1)
+                sys.stderr.write('flimage batch: %s: %s\n' % (name, e))
+                results.append({'name': name, 'dir': None,
+                                'status': 'failed', 'error': str(e),
+                                'elapsed': 0.0})
+                continue
+            jobs.append((spec['basename'], basedir, argv))
+            results.append(None)
+        if not jobs:
+            return results
+        # one process per build so that each has a clean environment
+        pool = multiprocessing.Pool(self.jobs, initWorker,
+                                    (self.buildFunction, self.resources),
+                                    maxtasksperchild=1)
+        try:
+            built = iter(pool.map(runBuild, jobs, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+        return [x or built.next() for x in results]
+
+
+def writeSummary(results, out):
+    width = max([len(str(x['name'])) for x in results] + [4])
+    out.write('%-*s  %-6s  %8s  %s\n' % (width, 'name', 'status',
+                                          'seconds', 'error'))
+    for result in results:
+        out.write('%-*s  %-6s  %8.1f  %s\n' % (width, result['name'],
+            result['status'], result['elapsed'], result['error'] or ''))
+    failed = len([x for x in results if x['status'] != 'ok'])
+    out.write('%d built, %d failed\n' % (len(results) - failed, failed))
+
+
+def main(argv, buildFunction):
+    ap = argparse.ArgumentParser(prog='flimage batch',
+                                 description='Build many images locally')
+    ap.add_argument('manifest',
+                    help='YAML or JSON file listing images to build')
+    ap.add_argument('-d', '--dir',
+                    help='work directory (overrides manifest workdir)')
+    ap.add_argument('-j', '--jobs', type=int,
+                    help='number of images to build at once')
+    ap.add_argument('--cpu-jobs', type=int,
+                    help='concurrent CPU-bound steps (initrd, compression)')
+    ap.add_argument('--io-jobs', type=int,
+                    help='concurrent I/O-bound steps (sync, copy)')
+    args = ap.parse_args(argv)
+
+    manifest = loadManifest(args.manifest)
+    workdir = args.dir or manifest.get('workdir') or os.getcwd()
+    jobs = args.jobs or manifest.get('jobs') or multiprocessing.cpu_count()
+    cpuJobs = args.cpu_jobs or manifest.get('cpu-jobs')
+    ioJobs = args.io_jobs or manifest.get('io-jobs')
+
+    BB = BatchBuilder(buildFunction, jobs, cpuJobs, ioJobs)
+    results = BB.run(manifest.get('images', []), workdir)
+    writeSummary(results, sys.stdout)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    file(workdir + '/batch-summary.json', 'w').write(
+        json.dumps(results, indent=2) + '\n')
+    if [x for x in results if x['status'] != 'ok']:
+        return 1
+    return 0
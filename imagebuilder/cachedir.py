@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# the directory layout shared by the snapshot, initrd and layer caches:
+# each entry is a directory named by a hash, complete once it holds a
+# "size" file with the disk space it takes.  Entries are built in
+# temporary directories and renamed into place, so a partial entry is
+# never used and the directory can be shared by concurrent builds, and
+# the mtime of each entry records its last use for LRU eviction.
+#
+# Builds copying an entry out hold a shared flock on its directory.
+# Eviction skips entries it cannot lock exclusively, and renames an
+# entry away before removing it, so that a build that opened it just
+# before finds it gone rather than copying a partly removed tree.
+
+import contextlib
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+
+
+def treeSize(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+    return size
+
+
+class CacheDirectory(object):
+    def __init__(self, directory, maxSize=None):
+        self.dir = directory
+        # maxSize in bytes; None means unbounded
+        self.maxSize = maxSize
+
+    def entryExists(self, entry):
+        return os.path.exists(entry + '/size')
+
+    def touchEntry(self, entry):
+        now = time.time()
+        os.utime(entry, (now, now))
+
+    @contextlib.contextmanager
+    def lockedEntry(self, entry):
+        # yields whether entry is there to be copied out; it is not
+        # evicted until the with block ends
+        try:
+            fd = os.open(entry, os.O_RDONLY)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            yield False
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                present = (self.entryExists(entry) and
+                           os.stat(entry).st_ino == os.fstat(fd).st_ino)
+            except OSError:
+                present = False
+            yield present
+        finally:
+            os.close(fd)
+
+    def removeEntry(self, entry):
+        # returns False if entry is in use or already gone
+        try:
+            fd = os.open(entry, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            doomed = '%s/.evict.%s.%d' % (self.dir, os.path.basename(entry),
+                                          os.getpid())
+            try:
+                os.rename(entry, doomed)
+            except OSError:
+                # another build evicted it first
+                return False
+        finally:
+            os.close(fd)
+        shutil.rmtree(doomed, ignore_errors=True)
+        return True
+
+    def publish(self, entry, fill, prefix='.entry.'):
+        # fill(directory) writes the contents of the entry
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        tmpEntry = tempfile.mkdtemp(prefix=prefix, dir=self.dir)
+        try:
+            fill(tmpEntry)
+            file(tmpEntry + '/size', 'w').write('%d\n' % treeSize(tmpEntry))
+            try:
+                os.rename(tmpEntry, entry)
+            except OSError:
+                if not self.entryExists(entry):
+                    raise
+                # another build published the same entry first
+                shutil.rmtree(tmpEntry, ignore_errors=True)
+        except:
+            shutil.rmtree(tmpEntry, ignore_errors=True)
+            raise
+
+    def entries(self):
+        # (mtime, size, entry), least recently used first
+        entries = []
+        for name in os.listdir(self.dir):
+            entry = '/'.join((self.dir, name))
+            sizeFile = entry + '/size'
+            if name.startswith('.') or not os.path.exists(sizeFile):
+                continue
+            entries.append((os.stat(entry).st_mtime,
+                            int(file(sizeFile).read()), entry))
+        return sorted(entries)
+
+    def evict(self, keep=()):
+        # entries in keep are still in use by this build
+        if self.maxSize is None:
+            return
+        entries = self.entries()
+        total = sum(x[1] for x in entries)
+        for mtime, size, entry in entries:
+            if total <= self.maxSize:
+                break
+            if entry in keep:
+                continue
+            if self.removeEntry(entry):
+                total -= size
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# places a build in a cgroup-v2 subtree of its own, optionally with
+# cpu.weight, io.weight, io.max and memory.high limits, and the
+# commands run during each stage in cgroups of their own, so that what
+# the build and each stage used can be reported at the end:
+#
+#   CGROUP2/flimage/            holds no processes; delegates controllers
+#     BASENAME.PID/             limits, and totals for the build
+#       flimage/                the flimage process and its helpers
+#       STAGE/                  commands run during STAGE
+#
+# cgroup v2 only allows processes in leaves, hence flimage/.  Commands
+# join their stage's cgroup between fork and exec, so that everything
+# they start is counted with them.  The chroot executor cannot see the
+# cgroup filesystem after it chroots, so it opens the build's cgroup
+# directory first and commands run in the image join their stage
+# through /proc/PID/fd.  Commands started from threads of a stage's
+# own (such as concurrent archive extraction) are counted only in the
+# totals for the build.
+
+import contextlib
+import os
+import threading
+
+controllers = ('cpu', 'io', 'memory')
+
+
+def mountPoint():
+    # where the cgroup2 filesystem is mounted, also on hosts that
+    # mount it beside cgroup v1 hierarchies
+    for line in file('/proc/mounts'):
+        fields = line.split()
+        if fields[2] == 'cgroup2':
+            return fields[1]
+    return None
+
+
+def writeFile(path, value):
+    f = file(path, 'w')
+    try:
+        f.write(value)
+    finally:
+        f.close()
+
+
+def readValues(path):
+    # "key value" lines, as in cpu.stat
+    values = {}
+    if os.path.exists(path):
+        for line in file(path):
+            fields = line.split()
+            if len(fields) == 2:
+                values[fields[0]] = int(fields[1])
+    return values
+
+
+def joinCgroup(path):
+    # between fork and exec: a command that cannot be moved is still
+    # counted in the totals for the build, so errors are ignored
+    try:
+        fd = os.open(path + '/cgroup.procs', os.O_WRONLY)
+        try:
+            os.write(fd, '0')
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def usage(path):
+    figures = {}
+    cpu = readValues(path + '/cpu.stat')
+    for key in ('usage_usec', 'user_usec', 'system_usec'):
+        if key in cpu:
+            figures[key[:-5]] = cpu[key] / 1e6
+    if os.path.exists(path + '/memory.peak'):
+        figures['memoryPeak'] = int(file(path + '/memory.peak').read())
+    if os.path.exists(path + '/io.stat'):
+        figures['read'] = figures['written'] = 0
+        for line in file(path + '/io.stat'):
+            for field in line.split()[1:]:
+                key, value = field.split('=')
+                if key == 'rbytes':
+                    figures['read'] += int(value)
+                elif key == 'wbytes':
+                    figures['written'] += int(value)
+    # pressure stall information: time in which some (or all) tasks
+    # were waiting for the resource
+    for resource in controllers:
+        pressure = path + '/%s.pressure' % resource
+        if not os.path.exists(pressure):
+            continue
+        for line in file(pressure):
+            fields = line.split()
+            total = [x for x in fields if x.startswith('total=')]
+            if total:
+                figures['%sStall%s' % (resource, fields[0].capitalize())] = (
+                    int(total[0][6:]) / 1e6)
+    return figures
+
+
+def describe(figures):
+    parts = []
+    if 'usage' in figures:
+        parts.append('cpu %.1fs (%.1fs user, %.1fs system)' % (
+            figures['usage'], figures.get('user', 0),
+            figures.get('system', 0)))
+    if 'memoryPeak' in figures:
+        parts.append('memory peak %.1fMiB' % (
+            figures['memoryPeak'] / 1048576.0))
+    if 'read' in figures:
+        parts.append('read %.1fMiB, written %.1fMiB' % (
+            figures['read'] / 1048576.0, figures['written'] / 1048576.0))
+    stalls = []
+    for resource in controllers:
+        some = figures.get('%sStallSome' % resource)
+        full = figures.get('%sStallFull' % resource)
+        if some is None:
+            continue
+        if full is None:
+            stalls.append('%s %.1fs' % (resource, some))
+        else:
+            stalls.append('%s %.1fs/%.1fs' % (resource, some, full))
+    if stalls:
+        parts.append('stalled (some/full) ' + ', '.join(stalls))
+    return ', '.join(parts)
+
+
+class NullCgroup(object):
+    # used when builds are not placed in cgroups
+    path = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def current(self):
+        return None
+
+    def popenArgs(self):
+        return {}
+
+    def report(self):
+        return []
+
+
+class BuildCgroup(object):
+    def __init__(self, name, parent='flimage', cpuWeight=None,
+                 ioWeight=None, ioMax=(), memoryHigh=None, stages=False):
+        self.root = mountPoint()
+        if self.root is None:
+            raise IOError('no cgroup2 filesystem is mounted')
+        self.parent = '/'.join((self.root, parent))
+        self.path = '/'.join((self.parent, name))
+        self.cpuWeight = cpuWeight
+        self.ioWeight = ioWeight
+        self.ioMax = ioMax
+        self.memoryHigh = memoryHigh
+        self.stages = stages
+        self.stageNames = []
+        self.local = threading.local()
+        self.origin = None
+
+    def enableControllers(self, path):
+        available = file(path + '/cgroup.controllers').read().split()
+        wanted = ' '.join('+' + x for x in controllers if x in available)
+        if wanted:
+            writeFile(path + '/cgroup.subtree_control', wanted)
+
+    def create(self):
+        # controllers have to be enabled in every ancestor
+        path = self.root
+        self.enableControllers(path)
+        for component in self.parent[len(self.root) + 1:].split('/'):
+            path = '/'.join((path, component))
+            if not os.path.exists(path):
+                os.mkdir(path)
+            self.enableControllers(path)
+        os.mkdir(self.path)
+        try:
+            self.configure()
+        except:
+            if os.path.exists(self.path + '/flimage'):
+                os.rmdir(self.path + '/flimage')
+            os.rmdir(self.path)
+            raise
+        for line in file('/proc/self/cgroup'):
+            if line.startswith('0::'):
+                self.origin = self.root + line[3:].strip().rstrip('/')
+        writeFile(self.path + '/flimage/cgroup.procs', '%d' % os.getpid())
+
+    def configure(self):
+        limits = []
+        if self.cpuWeight is not None:
+            limits.append(('cpu.weight', '%d' % self.cpuWeight))
+        if self.ioWeight is not None:
+            limits.append(('io.weight', 'default %d' % self.ioWeight))
+        for limit in self.ioMax:
+            limits.append(('io.max', limit))
+        if self.memoryHigh is not None:
+            limits.append(('memory.high', self.memoryHigh))
+        for name, value in limits:
+            if not os.path.exists('/'.join((self.path, name))):
+                raise IOError('%s is not available in %s; is the %s'
+                              ' controller enabled?' % (name, self.root,
+                                                        name.split('.')[0]))
+            writeFile('/'.join((self.path, name)), value)
+        self.enableControllers(self.path)
+        os.mkdir(self.path + '/flimage')
+
+    def destroy(self):
+        try:
+            writeFile(self.origin + '/cgroup.procs', '%d' % os.getpid())
+        except (IOError, TypeError):
+            # the original cgroup has since delegated its controllers
+            writeFile(self.root + '/cgroup.procs', '%d' % os.getpid())
+        for name in ['flimage'] + self.stageNames + [None]:
+            path = self.path
+            if name is not None:
+                path = '/'.join((self.path, name))
+            try:
+                os.rmdir(path)
+            except OSError:
+                # a process left behind; removed with the next build's
+                pass
+
+    def stagePath(self, name):
+        return '/'.join((self.path, name.replace('/', '_')))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.stages:
+            yield
+            return
+        path = self.stagePath(name)
+        if not os.path.exists(path):
+            os.mkdir(path)
+            self.stageNames.append(os.path.basename(path))
+        previous = self.current()
+        self.local.stage = os.path.basename(path)
+        try:
+            yield
+        finally:
+            self.local.stage = previous
+
+    def current(self):
+        # the stage cgroup of the calling thread, relative to the build
+        return getattr(self.local, 'stage', None)
+
+    def popenArgs(self):
+        # arguments for plumbum and subprocess that place the command
+        # in the cgroup of the current stage
+        stage = self.current()
+        if stage is None:
+            return {}
+        path = '/'.join((self.path, stage))
+        return {'preexec_fn': lambda: joinCgroup(path)}
+
+    def report(self):
+        # (name, usage) for the build and each stage, in order
+        figures = [(os.path.basename(self.path), usage(self.path))]
+        for name in self.stageNames:
+            figures.append((name, usage('/'.join((self.path, name)))))
+        return figures
@@ -0,0 +1,401 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# stores conary changeset files so that every build of the same troves
+# installs from local files instead of downloading them again.
+#
+# Before conary sync runs, the system model is resolved with
+# "conary sync --info" into jobs: a package or group and the
+# components installed with it.  The jobs are stored by the same hash
+# of the model as the modelcache cache uses, so later builds of the
+# model do not resolve it again ("flimage prefetch" always does, to
+# pick up new versions).  Each job is fetched as one changeset with
+# "conary changeset --no-recurse", stored under the sha256 of its
+# contents with an index entry from the job to it, and conary sync
+# installs from the stored files with --from-file.
+#
+# Like the modelcache cache, the directory may be shared by concurrent
+# builders: files are published by renaming complete temporary files
+# into place while holding an exclusive lock on the directory's .lock
+# file, and the mtime of each changeset records its last use for LRU
+# eviction.  Changesets used by the current build are not evicted.
+#
+# Changesets missing from the store are fetched from a list of
+# repositories in turn: another store (for instance one shared
+# read-only between build hosts, or a directory standing in for the
+# repository in tests) and then the conary repositories themselves.
+#
+# usage: flimage prefetch -C DIR [--manifest batch.yaml] [model ...]
+
+import argparse
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from plumbum.cmd import conary
+
+from imagebuilder import batch
+from imagebuilder import mcc
+
+# "conary sync --info --full-versions --flavors" lists one job per
+# line, such as
+#   Install foo(:devel :runtime)=/example.com@ex:1/1.0-1-1[is: x86_64]
+jobLine = re.compile(r'^\s*(?P<action>Install|Update|Erase|Downgrade|Replace)'
+                     r'\s+(?P<name>[^\s(=]+)'
+                     r'(\((?P<components>[^)]*)\))?'
+                     r'(=(?P<version>[^\[\s]+)(?P<flavor>\[[^\]]*\])?)?')
+
+
+def parseJobs(text):
+    # returns None unless every job installs a new trove; updates and
+    # erasures only happen in roots that already have troves installed
+    jobs = []
+    for line in text.split('\n'):
+        match = jobLine.match(line)
+        if not match:
+            continue
+        if match.group('action') != 'Install' or not match.group('version'):
+            return None
+        spec = '=%s%s' % (match.group('version'), match.group('flavor') or '')
+        name = match.group('name')
+        job = [name + spec]
+        for component in (match.group('components') or '').split():
+            job.append(name + component + spec)
+        jobs.append(job)
+    # nothing to install means the output was not understood
+    return jobs or None
+
+
+def jobKey(job):
+    return hashlib.sha1('\n'.join(sorted(job))).hexdigest()
+
+
+class ConaryRepository(object):
+    # fetches from the repositories conary is configured to use
+    def __init__(self, run):
+        self.run = run
+
+    def fetch(self, job, path):
+        self.run(conary[('changeset', '--no-recurse') + tuple(job) + (path,)])
+        return True
+
+
+class MirrorRepository(object):
+    # copies from another changeset store
+    def __init__(self, directory):
+        self.store = ChangesetCache(directory)
+
+    def fetch(self, job, path):
+        source = self.store.lookup(job, touch=False)
+        if source is None:
+            return False
+        shutil.copyfile(source, path)
+        return True
+
+
+class ChangesetCache(object):
+    def __init__(self, directory, modeltext=None, maxBytes=None):
+        self.dir = directory
+        # maxBytes limits the size of the stored changesets; None
+        # means unbounded
+        self.maxBytes = maxBytes
+        self.hash = None
+        if modeltext is not None:
+            self.hash = mcc.modelHash(modeltext)
+        self.lockfile = '/'.join((self.dir, '.lock'))
+        self.statsfile = '/'.join((self.dir, '.stats'))
+        # changesets used by this build
+        self.using = set()
+        self.result = {}
+
+    @contextlib.contextmanager
+    def locked(self, operation):
+        for subdir in ('', '/jobs', '/troves', '/objects'):
+            if not os.path.exists(self.dir + subdir):
+                try:
+                    os.makedirs(self.dir + subdir)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+        f = file(self.lockfile, 'a')
+        try:
+            fcntl.flock(f.fileno(), operation)
+            yield
+        finally:
+            f.close()
+
+    def jobsFile(self):
+        return '/'.join((self.dir, 'jobs', self.hash))
+
+    def indexFile(self, job):
+        return '/'.join((self.dir, 'troves', jobKey(job)))
+
+    def objectFile(self, digest):
+        return '/'.join((self.dir, 'objects', digest + '.ccs'))
+
+    def publish(self, path, contents):
+        # caller holds the exclusive lock
+        fd, tmpname = tempfile.mkstemp(prefix='.tmp.', dir=self.dir)
+        try:
+            os.fchmod(fd, 0644)
+            os.write(fd, contents)
+            os.close(fd)
+            os.rename(tmpname, path)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def loadJobs(self):
+        with self.locked(fcntl.LOCK_SH):
+            try:
+                return json.loads(file(self.jobsFile()).read())
+            except (IOError, ValueError):
+                return None
+
+    def storeJobs(self, jobs):
+        with self.locked(fcntl.LOCK_EX):
+            self.publish(self.jobsFile(), json.dumps(jobs, indent=1) + '\n')
+
+    def resolve(self, run, root):
+        # the jobs that conary sync would perform in root
+        return parseJobs(run(conary['sync', '--info', '--full-versions',
+                                    '--flavors', '--root', root]))
+
+    def lookup(self, job, touch=True):
+        # files are replaced atomically, so no lock is needed to read
+        # them, and a store shared read-only can be used as a mirror.
+        # Changesets just used are the last to be evicted, so another
+        # build can only evict them if the store is smaller than one
+        # build's changesets.
+        try:
+            digest = file(self.indexFile(job)).read().strip()
+        except IOError:
+            return None
+        path = self.objectFile(digest)
+        if not os.path.exists(path):
+            # evicted
+            return None
+        if touch:
+            # record use for LRU eviction
+            now = time.time()
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                return None
+        return path
+
+    def fetch(self, job, repositories):
+        fd, tmpname = tempfile.mkstemp(prefix='.fetch.', suffix='.ccs',
+                                       dir=self.dir)
+        os.close(fd)
+        try:
+            for repository in repositories:
+                if repository.fetch(job, tmpname):
+                    break
+            else:
+                raise IOError('changeset not found: %s' % ' '.join(job))
+            h = hashlib.sha256()
+            f = file(tmpname)
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+            f.close()
+            path = self.objectFile(h.hexdigest())
+            with self.locked(fcntl.LOCK_EX):
+                if os.path.exists(path):
+                    os.unlink(tmpname)
+                else:
+                    os.chmod(tmpname, 0644)
+                    os.rename(tmpname, path)
+                self.publish(self.indexFile(job), h.hexdigest() + '\n')
+        except:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        return path
+
+    def get(self, job, repositories):
+        path = self.lookup(job)
+        if path is None:
+            path = self.fetch(job, repositories)
+            event = 'fetched'
+        else:
+            event = 'hit'
+        return event, path
+
+    def changesets(self, run, root, repositories, jobs=4, refresh=False):
+        # returns the changeset files to install in root, or None if
+        # the model cannot be installed from changesets
+        troveJobs = None
+        if not refresh:
+            troveJobs = self.loadJobs()
+        if troveJobs is None:
+            troveJobs = self.resolve(run, root)
+            if troveJobs is None:
+                self.result = {'unresolved': 1}
+                return None
+            self.storeJobs(troveJobs)
+        pool = ThreadPool(max(1, jobs))
+        try:
+            results = pool.map(lambda x: self.get(x, repositories), troveJobs)
+        finally:
+            pool.close()
+            pool.join()
+        self.result = {}
+        for event, path in results:
+            self.result[event] = self.result.get(event, 0) + 1
+            self.using.add(path)
+        with self.locked(fcntl.LOCK_EX):
+            for event, count in self.result.items():
+                self._count(event, count)
+            self._evict()
+        return [x[1] for x in results]
+
+    def _entries(self):
+        entries = []
+        objects = '/'.join((self.dir, 'objects'))
+        for name in os.listdir(objects):
+            path = '/'.join((objects, name))
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def _evict(self):
+        # index entries of evicted changesets are left to be replaced
+        # when the changeset is fetched again
+        if self.maxBytes is None:
+            return
+        entries = self._entries()
+        total = sum(x[1] for x in entries)
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            if path in self.using:
+                continue
+            os.unlink(path)
+            total -= size
+            self._count('evicted')
+
+    def _count(self, event, count=1):
+        # caller holds the exclusive lock
+        stats = self._statistics()
+        stats[event] = stats.get(event, 0) + count
+        self.publish(self.statsfile, json.dumps(stats, sort_keys=True) + '\n')
+
+    def _statistics(self):
+        try:
+            return json.loads(file(self.statsfile).read())
+        except (IOError, ValueError):
+            return {}
+
+    def statistics(self):
+        # counts of hit, fetched, unresolved and evicted for the directory
+        with self.locked(fcntl.LOCK_SH):
+            stats = self._statistics()
+            entries = self._entries()
+        stats['changesets'] = len(entries)
+        stats['bytes'] = sum(x[1] for x in entries)
+        return stats
+
+
+def run(cmd):
+    sys.stdout.write(str(cmd) + '\n')
+    sys.stdout.flush()
+    return cmd()
+
+
+def prefetch(directory, modeltext, repositories, jobs, maxBytes=None,
+             modelcacheDir=None):
+    # resolves the model in an empty root and fetches its changesets
+    CC = ChangesetCache(directory, modeltext, maxBytes)
+    root = tempfile.mkdtemp(prefix='mkp.')
+    try:
+        os.makedirs(root + '/etc/conary')
+        file(root + '/etc/conary/system-model', 'w').write(modeltext)
+        MCC = None
+        if modelcacheDir:
+            MCC = mcc.ModelCacheCache(modelcacheDir, modeltext, root)
+            MCC.prime()
+        if CC.changesets(run, root, repositories, jobs, refresh=True) is None:
+            return None
+        if MCC is not None:
+            MCC.store()
+        return CC
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(prog='flimage prefetch',
+                                 description='Fetch the changesets for'
+                                 ' system models into a changeset cache')
+    ap.add_argument('models', nargs='*',
+                    help='files containing system models')
+    ap.add_argument('--manifest', action='append',
+                    help='batch manifest whose models to prefetch')
+    ap.add_argument('-C', '--changeset-cache', required=True,
+                    help='directory for cache of changesets')
+    ap.add_argument('--changeset-cache-size', type=int,
+                    help='maximum size of changeset cache in MiB')
+    ap.add_argument('--changeset-mirror', action='append',
+                    help='changeset cache to copy changesets from before'
+                         ' fetching from the repository')
+    ap.add_argument('-M', '--modelcache-cache',
+                    help='directory for cache of modelcache files')
+    ap.add_argument('-j', '--jobs', type=int, default=4,
+                    help='changesets to fetch at once [4]')
+    args = ap.parse_args(argv)
+
+    models = list(args.models)
+    for manifest in args.manifest or ():
+        for spec in batch.loadManifest(manifest).get('images', []):
+            if spec.get('model') and spec['model'] not in models:
+                models.append(spec['model'])
+    if not models:
+        ap.error('no system models to prefetch')
+
+    maxBytes = None
+    if args.changeset_cache_size:
+        maxBytes = args.changeset_cache_size * 1024 * 1024
+    repositories = [MirrorRepository(x) for x in args.changeset_mirror or ()]
+    repositories.append(ConaryRepository(run))
+    status = 0
+    for model in models:
+        CC = prefetch(args.changeset_cache, file(model).read(), repositories,
+                      args.jobs, maxBytes, args.modelcache_cache)
+        if CC is None:
+            sys.stderr.write('%s: could not resolve model into changesets\n'
+                             % model)
+            status = 1
+            continue
+        sys.stdout.write('%s: %s\n' % (model, ', '.join(
+            '%s %s' % x for x in sorted(CC.result.items()))))
+    CC = ChangesetCache(args.changeset_cache)
+    sys.stdout.write('changeset cache: %s\n' % ', '.join(
+        '%s %s' % x for x in sorted(CC.statistics().items())))
+    return status
@@ -0,0 +1,378 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# runs a build as a list of named stages, recording in a checkpoint
+# file after each stage its name, a hash of its inputs and the state
+# of the ImageBuilder.  When a stage fails after the system has been
+# installed, the partial image and root are kept; a later run with
+# resume set loops and mounts them again and continues from the first
+# stage that did not finish or whose inputs changed, running it and
+# all later stages on top of the existing root.
+#
+# Stages that are not resumable (everything up to and including the
+# installation of the system) cannot be run again on a partial root,
+# nor can stages that run after a final stage (one that changes the
+# image in ways later stages cannot redo, such as finishing or
+# shrinking the filesystem) once that final stage has completed; in
+# those cases the build starts over.
+#
+# Each stage declares the resources it reads and writes: 'image',
+# 'mounts' (loop devices and mounts), 'root' or a path within it such
+# as 'root/etc/inittab', or names for other state such as 'kver'.  A
+# stage depends on every earlier stage whose writes overlap what it
+# reads or writes, or whose reads overlap what it writes; stages that
+# declare nothing write '*' and so keep their place in the order.
+# Foreground stages run in order in the main thread; background
+# stages run in threads as soon as the stages they depend on have
+# finished.  Background stages must not run commands in the image.
+# At the end the time of each stage and the critical path, the chain
+# of dependencies that determined the total time, are printed.
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+def fileStamp(path):
+    # archives are identified by size and modification time rather
+    # than by hashing their contents on every run
+    st = os.stat(path)
+    return '%s:%d:%d' % (path, st.st_size, int(st.st_mtime))
+
+
+def inputsHash(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+class Stage(object):
+    def __init__(self, name, function, inputs=(), resumable=True,
+                 final=False, reads=(), writes=('*',), background=False):
+        self.name = name
+        self.function = function
+        self.inputs = inputsHash(inputs)
+        self.resumable = resumable
+        self.final = final
+        self.reads = tuple(reads)
+        self.writes = tuple(writes)
+        self.background = background
+
+
+def overlap(a, b):
+    return (a == '*' or b == '*' or a == b
+            or a.startswith(b + '/') or b.startswith(a + '/'))
+
+
+def conflicts(earlier, later):
+    for written in earlier.writes:
+        for used in later.reads + later.writes:
+            if overlap(written, used):
+                return True
+    for read in earlier.reads:
+        for written in later.writes:
+            if overlap(read, written):
+                return True
+    return False
+
+
+def dependencies(stages):
+    # maps each stage name to the earlier stages it must wait for
+    return dict((stage.name, [x for x in stages[:index]
+                              if conflicts(x, stage)])
+                for index, stage in enumerate(stages))
+
+
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+        # contents of the image's tmpfs mounts while suspended
+        self.saveDir = path + '.d'
+        # completed stages in order of completion: name, inputs,
+        # ImageBuilder state and live state
+        self.stages = []
+        self.suspended = False
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        data = json.loads(file(self.path).read())
+        self.stages = data['stages']
+        self.suspended = data['suspended']
+
+    def write(self):
+        fd, tmpname = tempfile.mkstemp(prefix='.checkpoint.',
+                                       dir=os.path.dirname(self.path))
+        try:
+            os.write(fd, json.dumps({'stages': self.stages,
+                                     'suspended': self.suspended},
+                                    sort_keys=True, indent=1) + '\n')
+            os.close(fd)
+            os.rename(tmpname, self.path)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def complete(self, stage, state, live):
+        with self.lock:
+            self.stages.append({'name': stage.name, 'inputs': stage.inputs,
+                                'state': state, 'live': live})
+            self.write()
+
+    def suspend(self):
+        self.suspended = True
+        self.write()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        shutil.rmtree(self.saveDir, ignore_errors=True)
+        self.stages = []
+        self.suspended = False
+
+    def records(self):
+        return dict((x['name'], x) for x in self.stages)
+
+    def resumePoint(self, stages):
+        # index of the first stage to run, or 0 to start over
+        records = self.records()
+        point = len(stages)
+        for index, stage in enumerate(stages):
+            record = records.get(stage.name)
+            if record is None or record['inputs'] != stage.inputs:
+                point = index
+                break
+        if point < len(stages) and not stages[point].resumable:
+            return 0
+        for stage in stages[point:]:
+            if stage.final and stage.name in records:
+                return 0
+        return point
+
+    def resumeRecord(self, stages, point):
+        # background stages may finish at any time, so the state to
+        # resume from is that after the last foreground stage
+        records = self.records()
+        for stage in reversed(stages[:point]):
+            if not stage.background:
+                return records[stage.name]
+
+    def truncate(self, stages, point):
+        names = set(x.name for x in stages[:point])
+        self.stages = [x for x in self.stages if x['name'] in names]
+
+
+class StageRunner(object):
+    def __init__(self, IB, stages, checkpoint=None, overlap=True):
+        self.IB = IB
+        self.stages = stages
+        self.checkpoint = checkpoint
+        self.overlap = overlap
+        self.dependencies = dependencies(stages)
+        self.condition = threading.Condition()
+        # name -> (start, end) of stages that ran, and exc_info of
+        # stages that failed
+        self.times = {}
+        self.skipped = set()
+        self.errors = {}
+        self.aborted = False
+        self.origin = time.time()
+
+    def finished(self, stage):
+        return (stage.name in self.times or stage.name in self.skipped
+                or stage.name in self.errors)
+
+    def wait(self, stage):
+        # returns the first failed dependency, if any
+        with self.condition:
+            while not self.aborted and not all(
+                    self.finished(x) for x in self.dependencies[stage.name]):
+                # a timeout keeps the wait interruptible
+                self.condition.wait(1)
+            for x in self.dependencies[stage.name]:
+                if x.name in self.errors:
+                    return x
+        return None
+
+    def execute(self, stage):
+        start = time.time()
+        try:
+            with self.IB.tracer.stage(stage.name):
+                with self.IB.cgroups.stage(stage.name):
+                    stage.function()
+        except:
+            with self.condition:
+                self.errors[stage.name] = sys.exc_info()
+                self.condition.notify_all()
+            return False
+        end = time.time()
+        if self.checkpoint is not None:
+            self.checkpoint.complete(stage, self.IB.saveState(),
+                                     self.IB.liveState())
+        with self.condition:
+            self.times[stage.name] = (start, end)
+            self.condition.notify_all()
+        return True
+
+    def background(self, stage):
+        failed = self.wait(stage)
+        if self.aborted:
+            return
+        if failed is not None:
+            with self.condition:
+                self.skipped.add(stage.name)
+                self.condition.notify_all()
+            return
+        self.execute(stage)
+
+    def run(self, start=0):
+        for stage in self.stages[:start]:
+            self.skipped.add(stage.name)
+        threads = []
+        if self.overlap:
+            for stage in self.stages[start:]:
+                if stage.background:
+                    thread = threading.Thread(target=self.background,
+                                              args=(stage,), name=stage.name)
+                    thread.start()
+                    threads.append(thread)
+        try:
+            for stage in self.stages[start:]:
+                if stage.background and self.overlap:
+                    continue
+                if self.errors:
+                    # a background stage failed
+                    break
+                failed = self.wait(stage)
+                if failed is not None:
+                    break
+                if not self.execute(stage):
+                    break
+        finally:
+            with self.condition:
+                if self.errors:
+                    self.aborted = True
+                self.condition.notify_all()
+            for thread in threads:
+                thread.join()
+
+    def failure(self):
+        # the first failed stage in build order and its exc_info
+        for stage in self.stages:
+            if stage.name in self.errors:
+                return stage, self.errors[stage.name]
+        return None, None
+
+    def criticalPath(self):
+        # walk back from the stage that finished last through whichever
+        # dependency (or preceding foreground stage) finished last
+        ran = [x for x in self.stages if x.name in self.times]
+        if not ran:
+            return []
+        previous = {}
+        foreground = None
+        for stage in self.stages:
+            predecessors = list(self.dependencies[stage.name])
+            if not (stage.background and self.overlap):
+                if foreground is not None:
+                    predecessors.append(foreground)
+                foreground = stage
+            previous[stage.name] = [x for x in predecessors
+                                    if x.name in self.times]
+        stage = max(ran, key=lambda x: self.times[x.name][1])
+        path = [stage]
+        while previous[stage.name]:
+            stage = max(previous[stage.name],
+                        key=lambda x: self.times[x.name][1])
+            path.append(stage)
+        path.reverse()
+        return path
+
+    def report(self, out=sys.stdout):
+        path = self.criticalPath()
+        onPath = set(x.name for x in path)
+        out.write('stage timings (* on critical path):\n')
+        for stage in self.stages:
+            if stage.name not in self.times:
+                continue
+            start, end = self.times[stage.name]
+            out.write('  %s %-16s %8.2fs +%.2fs%s\n' % (
+                stage.name in onPath and '*' or ' ', stage.name,
+                end - start, start - self.origin,
+                stage.background and self.overlap and ' (background)' or ''))
+        if path:
+            total = max(x[1] for x in self.times.values()) - self.origin
+            out.write('critical path: %s (%.2fs of %.2fs)\n' % (
+                ' -> '.join(x.name for x in path),
+                sum(self.times[x.name][1] - self.times[x.name][0]
+                    for x in path), total))
+        out.flush()
+
+
+def runStages(IB, stages, checkpoint=None, resume=False, overlap=True):
+    start = 0
+    if checkpoint is not None and checkpoint.exists():
+        checkpoint.load()
+        if resume and not checkpoint.suspended:
+            sys.stdout.write('previous build did not stop cleanly;'
+                             ' starting over\n')
+        elif resume:
+            start = checkpoint.resumePoint(stages)
+        if start:
+            record = checkpoint.resumeRecord(stages, start)
+            IB.resume(record['state'], record['live'], checkpoint.saveDir)
+            checkpoint.truncate(stages, start)
+            checkpoint.suspended = False
+            checkpoint.write()
+            if start < len(stages):
+                sys.stdout.write('resuming at stage %s\n' % stages[start].name)
+            sys.stdout.flush()
+        elif checkpoint.stages:
+            IB.discard(checkpoint.stages[-1]['state'])
+            checkpoint.remove()
+        else:
+            checkpoint.remove()
+
+    runner = StageRunner(IB, stages, checkpoint, overlap)
+    runner.run(start)
+    stage, exc = runner.failure()
+    if stage is None:
+        runner.report()
+        if checkpoint is not None:
+            checkpoint.remove()
+        return
+
+    if checkpoint is None or not stage.resumable:
+        IB.cleanUp()
+        if checkpoint is not None:
+            checkpoint.remove()
+        raise exc[0], exc[1], exc[2]
+    try:
+        IB.suspend(checkpoint.saveDir)
+        checkpoint.suspend()
+        sys.stderr.write('stage %s failed; partial image %s kept,'
+                         ' use --resume to continue\n' % (
+                         stage.name, IB.image))
+    except:
+        IB.cleanUp()
+        checkpoint.remove()
+    raise exc[0], exc[1], exc[2]
@@ -0,0 +1,399 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# stores finished images as chunks named by the sha256 of their
+# contents, so that chunks that consecutive builds have in common are
+# stored once, and writes deltas between stored images holding only
+# the chunks the older image does not have.
+#
+# Chunks are the export.BLOCK (64KiB) aligned blocks of the raw image,
+# hashed during the single export pass.  Filesystem blocks never
+# straddle them, so content-defined chunking would find no more
+# duplicates in filesystem images.  All-zero chunks are not stored.
+# Each stored image is a manifest giving its size, its sha256 and the
+# hash of each chunk (null for zeros) at images/NAME/VERSION.json,
+# where VERSION is the time it was stored; NAME@VERSION names one
+# image and NAME alone its latest version.
+#
+# Chunks and manifests are written to temporary files and renamed into
+# place, so concurrent builds can share a store.  Storing an image
+# holds a shared lock on .lock; removing images, which also deletes
+# the chunks no other image uses, holds it exclusively.
+#
+# A delta is a header line, a JSON line with the size and sha256 of
+# the target image and of the base image it applies to, a JSON list
+# with one entry per chunk (null for zeros, the index of a chunk of
+# the base image with the same contents, or -1 for a chunk included
+# in the delta), and then the included chunks in order.
+#
+# usage: flimage delta list STORE [NAME]
+#        flimage delta create STORE BASE TARGET -o FILE
+#        flimage delta apply BASE.img DELTA -o FILE
+#        flimage delta extract STORE NAME[@VERSION] -o FILE
+#        flimage delta remove STORE NAME@VERSION...
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from imagebuilder import export
+
+DELTA_MAGIC = 'FLIMAGE-DELTA 1\n'
+
+
+def chunkLength(size, index, chunkSize):
+    return min(chunkSize, size - index * chunkSize)
+
+
+class ChunkStore(object):
+    def __init__(self, directory):
+        self.dir = directory
+        self.lockfile = '/'.join((self.dir, '.lock'))
+
+    def lock(self, operation):
+        # returns the open lock file; closing it releases the lock
+        for subdir in ('', '/chunks', '/images'):
+            if not os.path.exists(self.dir + subdir):
+                try:
+                    os.makedirs(self.dir + subdir)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+        f = file(self.lockfile, 'a')
+        fcntl.flock(f.fileno(), operation)
+        return f
+
+    def publish(self, path, data):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, tmpname = tempfile.mkstemp(prefix='.tmp.', dir=directory)
+        try:
+            os.fchmod(fd, 0644)
+            os.write(fd, data)
+            os.close(fd)
+            os.rename(tmpname, path)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def chunkPath(self, digest):
+        return '/'.join((self.dir, 'chunks', digest[:2], digest))
+
+    def putChunk(self, digest, data):
+        # returns True if the chunk was not stored already
+        path = self.chunkPath(digest)
+        if os.path.exists(path):
+            return False
+        self.publish(path, data)
+        return True
+
+    def readChunk(self, digest):
+        return file(self.chunkPath(digest)).read()
+
+    def names(self):
+        return sorted(os.listdir(self.dir + '/images'))
+
+    def versions(self, name):
+        directory = '/'.join((self.dir, 'images', name))
+        if not os.path.isdir(directory):
+            return []
+        return sorted(x[:-5] for x in os.listdir(directory)
+                      if x.endswith('.json'))
+
+    def latest(self, name):
+        versions = self.versions(name)
+        if not versions:
+            return None
+        return '%s@%s' % (name, versions[-1])
+
+    def manifestPath(self, ref):
+        if '@' not in ref:
+            latest = self.latest(ref)
+            if latest is None:
+                raise IOError('no image %s in %s' % (ref, self.dir))
+            ref = latest
+        name, version = ref.split('@', 1)
+        return '/'.join((self.dir, 'images', name, version + '.json'))
+
+    def manifest(self, ref):
+        path = self.manifestPath(ref)
+        if not os.path.exists(path):
+            raise IOError('no image %s in %s' % (ref, self.dir))
+        return json.loads(file(path).read())
+
+    def storeManifest(self, name, manifest):
+        # returns the reference of the stored image
+        version = time.strftime('%Y%m%dT%H%M%S')
+        versions = self.versions(name)
+        suffix = 1
+        base = version
+        while version in versions:
+            version = '%s.%d' % (base, suffix)
+            suffix += 1
+        self.publish(self.manifestPath('%s@%s' % (name, version)),
+                     json.dumps(manifest) + '\n')
+        return '%s@%s' % (name, version)
+
+    def remove(self, refs):
+        # returns the number and size of the chunks deleted
+        lock = self.lock(fcntl.LOCK_EX)
+        try:
+            for ref in refs:
+                os.unlink(self.manifestPath(ref))
+            used = set()
+            for name in self.names():
+                for version in self.versions(name):
+                    used.update(x for x in self.manifest(
+                        '%s@%s' % (name, version))['chunks'] if x)
+                if not self.versions(name):
+                    os.rmdir('/'.join((self.dir, 'images', name)))
+            count = size = 0
+            for dirpath, dirnames, filenames in os.walk(self.dir + '/chunks'):
+                for name in filenames:
+                    if name not in used:
+                        path = '/'.join((dirpath, name))
+                        size += os.path.getsize(path)
+                        os.unlink(path)
+                        count += 1
+            return count, size
+        finally:
+            lock.close()
+
+    def extract(self, ref, path):
+        manifest = self.manifest(ref)
+        chunkSize = manifest['chunkSize']
+        f = file(path, 'w')
+        try:
+            h = hashlib.sha256()
+            f.truncate(manifest['size'])
+            for index, digest in enumerate(manifest['chunks']):
+                length = chunkLength(manifest['size'], index, chunkSize)
+                if digest is None:
+                    export.hashZeros(h, length)
+                    continue
+                data = self.readChunk(digest)
+                h.update(data)
+                f.seek(index * chunkSize)
+                f.write(data)
+        finally:
+            f.close()
+        if h.hexdigest() != manifest['sha256']:
+            raise IOError('%s does not match %s' % (path, ref))
+
+    def writeDelta(self, baseRef, targetRef, path):
+        # returns the number of chunks included in the delta
+        base = self.manifest(baseRef)
+        target = self.manifest(targetRef)
+        if base['chunkSize'] != target['chunkSize']:
+            raise IOError('%s and %s use different chunk sizes' % (
+                baseRef, targetRef))
+        baseChunks = {}
+        for index, digest in enumerate(base['chunks']):
+            if digest is not None and digest not in baseChunks:
+                baseChunks[digest] = index
+        entries = []
+        included = []
+        for digest in target['chunks']:
+            if digest is None:
+                entries.append(None)
+            elif digest in baseChunks:
+                entries.append(baseChunks[digest])
+            else:
+                entries.append(-1)
+                included.append(digest)
+        fd, tmpname = tempfile.mkstemp(prefix='.delta.',
+                                       dir=os.path.dirname(path) or '.')
+        try:
+            f = os.fdopen(fd, 'w')
+            f.write(DELTA_MAGIC)
+            f.write(json.dumps({
+                'size': target['size'],
+                'sha256': target['sha256'],
+                'chunkSize': target['chunkSize'],
+                'baseSize': base['size'],
+                'baseSha256': base['sha256'],
+            }) + '\n')
+            f.write(json.dumps(entries) + '\n')
+            for digest in included:
+                f.write(self.readChunk(digest))
+            f.close()
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, path)
+        except:
+            os.unlink(tmpname)
+            raise
+        return len(included)
+
+
+def fileSha256(path):
+    h = hashlib.sha256()
+    f = file(path)
+    while True:
+        data = f.read(export.READSIZE)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+
+def applyDelta(basePath, deltaPath, path):
+    delta = file(deltaPath)
+    if delta.readline() != DELTA_MAGIC:
+        raise IOError('%s is not an image delta' % deltaPath)
+    header = json.loads(delta.readline())
+    entries = json.loads(delta.readline())
+    if (os.path.getsize(basePath) != header['baseSize']
+        or fileSha256(basePath) != header['baseSha256']):
+        raise IOError('%s is not the image %s applies to' % (
+            basePath, deltaPath))
+    chunkSize = header['chunkSize']
+    base = file(basePath)
+    f = file(path, 'w')
+    try:
+        h = hashlib.sha256()
+        f.truncate(header['size'])
+        for index, entry in enumerate(entries):
+            length = chunkLength(header['size'], index, chunkSize)
+            if entry is None:
+                export.hashZeros(h, length)
+                continue
+            if entry < 0:
+                data = delta.read(length)
+            else:
+                base.seek(entry * chunkSize)
+                data = base.read(length)
+            if len(data) != length:
+                raise IOError('unexpected end of %s' % deltaPath)
+            h.update(data)
+            f.seek(index * chunkSize)
+            f.write(data)
+    finally:
+        f.close()
+        base.close()
+        delta.close()
+    if h.hexdigest() != header['sha256']:
+        raise IOError('%s does not match the target of %s' % (
+            path, deltaPath))
+
+
+class ChunkStoreArtifact(object):
+    # stores the image in a ChunkStore during the export pass
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.hash = hashlib.sha256()
+        self.ref = None
+        self.newChunks = 0
+        self.lock = None
+
+    def begin(self, size, extents):
+        self.lock = self.store.lock(fcntl.LOCK_SH)
+        self.size = size
+        self.chunks = [None] * export.ceilDiv(size, export.BLOCK)
+
+    def data(self, offset, buf, zero):
+        self.hash.update(buf)
+        if zero:
+            return
+        digest = hashlib.sha256(buf).hexdigest()
+        if self.store.putChunk(digest, buf):
+            self.newChunks += 1
+        self.chunks[offset / export.BLOCK] = digest
+
+    def hole(self, offset, length):
+        export.hashZeros(self.hash, length)
+
+    def end(self):
+        try:
+            self.ref = self.store.storeManifest(self.name, {
+                'size': self.size,
+                'sha256': self.hash.hexdigest(),
+                'chunkSize': export.BLOCK,
+                'chunks': self.chunks,
+            })
+        finally:
+            self.lock.close()
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(prog='flimage delta',
+                                 description='Manage stored images and'
+                                 ' deltas between them')
+    commands = ap.add_subparsers(dest='command')
+    sp = commands.add_parser('list', help='list stored images')
+    sp.add_argument('store')
+    sp.add_argument('name', nargs='?')
+    sp = commands.add_parser('create', help='write a delta between two'
+                             ' stored images')
+    sp.add_argument('store')
+    sp.add_argument('base', help='NAME[@VERSION] the delta applies to')
+    sp.add_argument('target', help='NAME[@VERSION] the delta produces')
+    sp.add_argument('-o', '--output', required=True)
+    sp = commands.add_parser('apply', help='apply a delta to an image file')
+    sp.add_argument('base', help='image file the delta applies to')
+    sp.add_argument('delta')
+    sp.add_argument('-o', '--output', required=True)
+    sp = commands.add_parser('extract', help='write a stored image to a file')
+    sp.add_argument('store')
+    sp.add_argument('ref', help='NAME[@VERSION]')
+    sp.add_argument('-o', '--output', required=True)
+    sp = commands.add_parser('remove', help='remove stored images and the'
+                             ' chunks only they use')
+    sp.add_argument('store')
+    sp.add_argument('refs', nargs='+', help='NAME@VERSION')
+    args = ap.parse_args(argv)
+
+    try:
+        if args.command == 'apply':
+            applyDelta(args.base, args.delta, args.output)
+            return 0
+        store = ChunkStore(args.store)
+        if args.command == 'list':
+            names = args.name and [args.name] or store.names()
+            for name in names:
+                for version in store.versions(name):
+                    manifest = store.manifest('%s@%s' % (name, version))
+                    sys.stdout.write('%s@%s %d %s\n' % (
+                        name, version, manifest['size'], manifest['sha256']))
+        elif args.command == 'create':
+            included = store.writeDelta(args.base, args.target, args.output)
+            sys.stdout.write('%s: %d chunks included\n' % (
+                args.output, included))
+        elif args.command == 'extract':
+            store.extract(args.ref, args.output)
+        elif args.command == 'remove':
+            for ref in args.refs:
+                if '@' not in ref:
+                    ap.error('remove needs NAME@VERSION: %s' % ref)
+            count, size = store.remove(args.refs)
+            sys.stdout.write('%d chunks (%d bytes) removed\n' % (count, size))
+    except IOError, e:
+        sys.stderr.write('flimage delta: %s\n' % e)
+        return 1
+    return 0
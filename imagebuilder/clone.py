@@ -15,7 +15,8 @@
 #  limitations under the License.
 #
 
-# wrapper around SYS_clone system call
+# wrapper around SYS_clone system call, and other libc calls
+# that python does not expose
 
 import ctypes
 import os
@@ -44,6 +45,9 @@ CLONE_NEWPID = 0x20000000	# New pid namespace.
 CLONE_NEWNET = 0x40000000	# New network namespace.
 CLONE_IO = 0x80000000	# Clone I/O context.
 
+FALLOC_FL_KEEP_SIZE = 0x01 # Do not change the file size.
+FALLOC_FL_PUNCH_HOLE = 0x02 # Deallocate the range; requires KEEP_SIZE.
+
 # intended to raise an error early if current architecture not supported
 hostbits = 64 if True in ['/lib64/' in x for x in sys.path] else 32
 architecture = os.uname()[4]
@@ -65,20 +69,38 @@ SYS_getpid = {
 class LateBoundLibc(object):
     def __init__(self):
         self.libc = None
+        self.pylibc = None
 
     def _bind(self):
         if self.libc is None:
-            self.libc = ctypes.CDLL('libc.so.6')
+            self.libc = ctypes.CDLL('libc.so.6', use_errno=True)
+            # calls through PyDLL keep the GIL
+            self.pylibc = ctypes.PyDLL('libc.so.6', use_errno=True)
 
     def syscall(self, *args):
         self._bind()
         return self.libc.syscall(*args)
 
+    def lockedSyscall(self, *args):
+        self._bind()
+        return self.pylibc.syscall(*args)
+
+    def fallocate(self, fd, mode, offset, length):
+        self._bind()
+        ret = self.libc.fallocate64(fd, mode, ctypes.c_int64(offset),
+                                    ctypes.c_int64(length))
+        if ret != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
 libc = LateBoundLibc()
 
 def clone(flags):
-    # we do not support child stacks or thread IDs
-    return libc.syscall(SYS_clone, ctypes.c_uint32(flags),
+    # we do not support child stacks or thread IDs.  The GIL is held
+    # across the call, so that when other threads are running (build
+    # stages in the background) the child does not inherit it locked
+    # by a thread that does not exist in the child
+    return libc.lockedSyscall(SYS_clone, ctypes.c_uint32(flags),
         ctypes.c_uint32(0), ctypes.c_uint32(0), ctypes.c_uint32(0))
 
 def getpid():
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# tunes and copies the conary database in-process with the sqlite3
+# module instead of running sqlite3 and cp for each operation.  The
+# copy uses VACUUM INTO where SQLite supports it (3.27 and later),
+# producing a compact, defragmented database in one step; otherwise it
+# uses the SQLite online backup API in large page batches, through
+# ctypes where python does not expose it, followed by a VACUUM.
+
+import ctypes
+import ctypes.util
+import os
+import sqlite3
+import time
+
+SQLITE_OK = 0
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+SQLITE_DONE = 101
+SQLITE_OPEN_READONLY = 0x01
+SQLITE_OPEN_READWRITE = 0x02
+SQLITE_OPEN_CREATE = 0x04
+
+
+class LateBoundSqlite(object):
+    def __init__(self):
+        self.lib = None
+
+    def _bind(self):
+        if self.lib is None:
+            lib = ctypes.CDLL(ctypes.util.find_library('sqlite3'))
+            lib.sqlite3_open_v2.argtypes = [ctypes.c_char_p,
+                ctypes.POINTER(ctypes.c_void_p), ctypes.c_int,
+                ctypes.c_char_p]
+            lib.sqlite3_close.argtypes = [ctypes.c_void_p]
+            lib.sqlite3_backup_init.restype = ctypes.c_void_p
+            lib.sqlite3_backup_init.argtypes = [ctypes.c_void_p,
+                ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+            lib.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            lib.sqlite3_backup_finish.argtypes = [ctypes.c_void_p]
+            lib.sqlite3_errmsg.restype = ctypes.c_char_p
+            lib.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+            self.lib = lib
+
+    def open(self, path, flags):
+        self._bind()
+        db = ctypes.c_void_p()
+        rc = self.lib.sqlite3_open_v2(path, ctypes.byref(db), flags, None)
+        if rc != SQLITE_OK:
+            self.lib.sqlite3_close(db)
+            raise sqlite3.OperationalError('cannot open %s: %d' % (path, rc))
+        return db
+
+    def backup(self, source, destination, pages):
+        self._bind()
+        src = self.open(source, SQLITE_OPEN_READONLY)
+        try:
+            dst = self.open(destination,
+                            SQLITE_OPEN_READWRITE|SQLITE_OPEN_CREATE)
+            try:
+                backup = self.lib.sqlite3_backup_init(dst, 'main', src, 'main')
+                if not backup:
+                    raise sqlite3.OperationalError(
+                        self.lib.sqlite3_errmsg(dst))
+                rc = SQLITE_OK
+                while rc in (SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED):
+                    rc = self.lib.sqlite3_backup_step(backup, pages)
+                self.lib.sqlite3_backup_finish(backup)
+                if rc != SQLITE_DONE:
+                    raise sqlite3.OperationalError(
+                        self.lib.sqlite3_errmsg(dst))
+            finally:
+                self.lib.sqlite3_close(dst)
+        finally:
+            self.lib.sqlite3_close(src)
+
+libsqlite = LateBoundSqlite()
+
+
+def tune(path, pageSize=4096, defaultCacheSize=2000):
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        db.execute('pragma default_cache_size=%d' % defaultCacheSize)
+        # takes effect when the database is rebuilt by vacuum
+        db.execute('pragma page_size=%d' % pageSize)
+        db.execute('vacuum')
+    finally:
+        db.close()
+
+
+def copy(source, destination, pageSize=4096, pages=8192):
+    # returns a list of (step, seconds, bytes) tuples
+    steps = []
+    start = time.time()
+    if sqlite3.sqlite_version_info >= (3, 27, 0):
+        db = sqlite3.connect(source, isolation_level=None)
+        try:
+            db.execute('pragma page_size=%d' % pageSize)
+            db.execute('vacuum into ?', (destination,))
+        finally:
+            db.close()
+        steps.append(('vacuum into', time.time() - start,
+                      os.path.getsize(destination)))
+        return steps
+
+    if hasattr(sqlite3.Connection, 'backup'):
+        src = sqlite3.connect(source)
+        dst = sqlite3.connect(destination)
+        try:
+            src.backup(dst, pages=pages)
+        finally:
+            dst.close()
+            src.close()
+    else:
+        libsqlite.backup(source, destination, pages)
+    steps.append(('backup', time.time() - start,
+                  os.path.getsize(destination)))
+
+    start = time.time()
+    db = sqlite3.connect(destination, isolation_level=None)
+    try:
+        db.execute('pragma page_size=%d' % pageSize)
+        db.execute('vacuum')
+    finally:
+        db.close()
+    steps.append(('vacuum', time.time() - start,
+                  os.path.getsize(destination)))
+    return steps
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# long-lived helper that enters a new PID and mount namespace and
+# chroots into the image once, then runs the commands sent to it over
+# a pipe, one JSON request per line.  For each command it replies with
+# the exit status, wall and CPU time, peak memory, bytes read and
+# written and the captured stderr.  The commands are children of the
+# executor, not of flimage, so these figures are the only record of
+# what they used.  As init
+# of its PID namespace it reaps orphans while commands run and
+# terminates any processes a command leaves behind before the next
+# command starts.
+
+import codecs
+import errno
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from imagebuilder import cgroup
+from imagebuilder import clone
+
+
+class ChrootExecutor(object):
+    def __init__(self, IB):
+        self.IB = IB
+        self.pid = None
+        self.requests = None
+        self.responses = None
+        # the build's cgroup directory, reached through /proc once the
+        # cgroup filesystem is outside the root
+        self.cgroupPath = None
+
+    def start(self):
+        requestRead, requestWrite = os.pipe()
+        responseRead, responseWrite = os.pipe()
+
+        pid = clone.clone(signal.SIGCHLD|clone.CLONE_NEWPID|clone.CLONE_NEWNS)
+        if pid < 0:
+            self.IB.raiseError('clone failed')
+
+        if pid == 0:
+            os.close(requestWrite)
+            os.close(responseRead)
+            try:
+                pid = clone.getpid()
+                if pid != 1:
+                    os.write(self.IB.errfd,
+                             'CONTAINER FAILED: pid %d !== 1\n' %(pid))
+                else:
+                    self.serve(requestRead, responseWrite)
+            except:
+                os.write(self.IB.errfd, traceback.format_exc())
+            os._exit(1)
+
+        os.close(requestRead)
+        os.close(responseWrite)
+        self.pid = pid
+        self.requests = os.fdopen(requestWrite, 'w')
+        self.responses = os.fdopen(responseRead, 'r')
+        os.write(self.IB.errfd, 'CHROOT EXECUTOR %d started in %s\n' %(
+            pid, self.IB.rootdir))
+
+    def serve(self, requestRead, responseWrite):
+        # keep mounts made by commands out of the host namespace
+        subprocess.call(['mount', '--make-rprivate', '/'],
+                        stdout=self.IB.errfd, stderr=self.IB.errfd)
+        # the image need not contain python: load the codec used for
+        # stderr before it becomes unreachable
+        codecs.lookup('utf-8')
+        cgroupFd = None
+        if self.IB.cgroups.path is not None:
+            cgroupFd = os.open(self.IB.cgroups.path, os.O_RDONLY)
+        os.chroot(self.IB.rootdir)
+        os.chdir('/')
+        if cgroupFd is not None:
+            try:
+                self.cgroupPath = '/proc/%s/fd/%d' % (
+                    os.readlink('/proc/self'), cgroupFd)
+            except OSError:
+                # no /proc in the image; commands count for the build
+                pass
+        requests = os.fdopen(requestRead, 'r')
+        responses = os.fdopen(responseWrite, 'w')
+        failedBatch = None
+        for line in iter(requests.readline, ''):
+            request = json.loads(line)
+            if request.get('exit'):
+                break
+            if request.get('parallel'):
+                response = {'results': self.executeParallel(request)}
+                responses.write(json.dumps(response) + '\n')
+                responses.flush()
+                continue
+            batch = request.get('batch')
+            if batch is not None and batch == failedBatch:
+                # an earlier command in the same batch failed
+                response = {'status': None, 'seconds': 0.0, 'user': 0.0,
+                            'system': 0.0, 'maxRss': 0, 'readBytes': 0,
+                            'writeBytes': 0, 'stderr': ''}
+            else:
+                response = self.execute(request)
+                if response['status'] != 0:
+                    failedBatch = batch
+            responses.write(json.dumps(response) + '\n')
+            responses.flush()
+        self.IB.reapStragglers()
+        os._exit(0)
+
+    def execute(self, request):
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        errors = tempfile.TemporaryFile(prefix='executor.', dir='/tmp')
+        stdout = None
+        if not request.get('fg'):
+            stdout = file('/dev/null', 'w')
+        try:
+            proc = subprocess.Popen(request['argv'], stdout=stdout,
+                                    stderr=errors, close_fds=True,
+                                    preexec_fn=self.joiner(request))
+            status, usage = self.IB.reapCommand(proc)
+            maxRss = usage.ru_maxrss
+        except OSError, e:
+            errors.write('%s: %s\n' % (request['argv'][0], e))
+            status = 127
+            maxRss = 0
+        self.IB.reapStragglers()
+        # the difference includes the orphans reaped on the way
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self.result(status, start, after.ru_utime - before.ru_utime,
+                           after.ru_stime - before.ru_stime, errors,
+                           maxRss, after.ru_inblock - before.ru_inblock,
+                           after.ru_oublock - before.ru_oublock)
+
+    def executeParallel(self, request):
+        # run up to request['jobs'] commands at once; wait4 gives the
+        # resource usage of each command separately
+        commands = list(enumerate(request['commands']))
+        results = [None] * len(commands)
+        running = {}
+        stdout = None
+        if not request.get('fg'):
+            stdout = file('/dev/null', 'w')
+        while commands or running:
+            while commands and len(running) < request['jobs']:
+                index, argv = commands.pop(0)
+                errors = tempfile.TemporaryFile(prefix='executor.', dir='/tmp')
+                start = time.time()
+                try:
+                    proc = subprocess.Popen(argv, stdout=stdout,
+                                            stderr=errors, close_fds=True,
+                                            preexec_fn=self.joiner(request))
+                except OSError, e:
+                    errors.write('%s: %s\n' % (argv[0], e))
+                    results[index] = self.result(127, start, 0.0, 0.0,
+                                                 errors)
+                    continue
+                # keep proc referenced: subprocess reaps children of
+                # Popen objects that are garbage collected
+                running[proc.pid] = (index, start, errors, proc)
+            if not running:
+                continue
+            try:
+                pid, status, usage = os.wait4(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in running:
+                # an orphan in the container exited
+                continue
+            index, start, errors, proc = running.pop(pid)
+            if os.WIFEXITED(status):
+                status = os.WEXITSTATUS(status)
+            else:
+                status = 128 + os.WTERMSIG(status)
+            proc.returncode = status
+            results[index] = self.result(status, start, usage.ru_utime,
+                                         usage.ru_stime, errors,
+                                         usage.ru_maxrss, usage.ru_inblock,
+                                         usage.ru_oublock)
+        self.IB.reapStragglers()
+        return results
+
+    def joiner(self, request):
+        # moves a command into the cgroup of the stage that requested it
+        stage = request.get('cgroup')
+        if stage is None or self.cgroupPath is None:
+            return None
+        path = '/'.join((self.cgroupPath, stage))
+        return lambda: cgroup.joinCgroup(path)
+
+    def result(self, status, start, user, system, errors, maxRss=0,
+               inblock=0, oublock=0):
+        # maxRss in KiB; inblock and oublock in 512-byte blocks
+        errors.seek(0)
+        text = errors.read()
+        errors.close()
+        if text:
+            os.write(self.IB.errfd, text)
+        return {
+            'status': status,
+            'start': start,
+            'seconds': time.time() - start,
+            'user': user,
+            'system': system,
+            'maxRss': maxRss,
+            'readBytes': inblock * 512,
+            'writeBytes': oublock * 512,
+            'stderr': text.decode('utf-8', 'replace'),
+        }
+
+    def submit(self, argv, fg=False, batch=None):
+        self.requests.write(json.dumps({'argv': argv, 'fg': fg,
+                                        'batch': batch,
+                                        'cgroup': self.IB.cgroups.current()})
+                            + '\n')
+
+    def response(self):
+        line = self.responses.readline()
+        if not line:
+            self.pid = None
+            self.IB.raiseError('chroot executor exited unexpectedly')
+        return json.loads(line)
+
+    def run(self, argv, fg=False):
+        self.submit(argv, fg)
+        self.requests.flush()
+        return self.response()
+
+    def runBatch(self, commands, fg=False):
+        # commands after the first failure are skipped (status None)
+        batch = time.time()
+        for argv in commands:
+            self.submit(argv, fg, batch)
+        self.requests.flush()
+        return [self.response() for argv in commands]
+
+    def runParallel(self, commands, jobs, fg=False):
+        # all commands run, with at most jobs at once; stragglers are
+        # only terminated once all of them have finished
+        self.requests.write(json.dumps({'parallel': True, 'jobs': jobs,
+                                        'commands': commands,
+                                        'fg': fg,
+                                        'cgroup': self.IB.cgroups.current()})
+                            + '\n')
+        self.requests.flush()
+        return self.response()['results']
+
+    def stop(self):
+        if self.pid is None:
+            return
+        try:
+            self.requests.write(json.dumps({'exit': True}) + '\n')
+            self.requests.close()
+        except IOError:
+            pass
+        self.responses.close()
+        os.waitpid(self.pid, 0)
+        os.write(self.IB.errfd, 'CHROOT EXECUTOR %d stopped\n' % self.pid)
+        self.pid = None
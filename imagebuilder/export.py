@@ -0,0 +1,349 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# produces the final artifacts for a raw image in a single read pass.
+# Only the regions reported by SEEK_DATA/SEEK_HOLE are read, all-zero
+# blocks within them are detected, and the sha256 of each artifact is
+# computed while it is written.
+#
+# Supported artifacts:
+#  raw   - the image itself; zero blocks are punched out if sparse
+#  vhd   - fixed VHD: the raw image (written sparse) plus a footer
+#  qcow2 - version 2 qcow2 allocating only clusters that hold data
+
+import errno
+import hashlib
+import os
+import struct
+import time
+import uuid
+
+from imagebuilder import clone
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# also the qcow2 cluster size
+BLOCK = 65536
+READSIZE = 16 * BLOCK
+ZEROS = '\0' * READSIZE
+
+formatSuffixes = {
+    'raw': '.img',
+    'qcow2': '.qcow2',
+    'vhd': '.vhd',
+}
+
+
+def ceilDiv(a, b):
+    return (a + b - 1) / b
+
+
+def hashZeros(h, length):
+    while length > 0:
+        n = min(length, READSIZE)
+        h.update(ZEROS[:n])
+        length -= n
+
+
+def dataExtents(fd, size):
+    # extents are rounded out to BLOCK boundaries and merged
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # no more data
+                    break
+                raise
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            start -= start % BLOCK
+            end = min(ceilDiv(end, BLOCK) * BLOCK, size)
+            if extents and start <= extents[-1][1]:
+                extents[-1] = (extents[-1][0], max(end, extents[-1][1]))
+            else:
+                extents.append((start, end))
+            offset = end
+    except OSError, e:
+        if e.errno != errno.EINVAL:
+            raise
+        # filesystem does not support SEEK_DATA; read everything
+        extents = [(0, size)]
+    return extents
+
+
+class RawArtifact(object):
+    def __init__(self, path, punch=True):
+        self.path = path
+        self.punch = punch
+        self.hash = hashlib.sha256()
+        self.fd = None
+
+    def begin(self, size, extents):
+        if self.punch:
+            self.fd = os.open(self.path, os.O_WRONLY)
+
+    def data(self, offset, buf, zero):
+        if zero and self.punch:
+            clone.libc.fallocate(self.fd,
+                clone.FALLOC_FL_PUNCH_HOLE|clone.FALLOC_FL_KEEP_SIZE,
+                offset, len(buf))
+        self.hash.update(buf)
+
+    def hole(self, offset, length):
+        hashZeros(self.hash, length)
+
+    def end(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+
+class VhdArtifact(object):
+    def __init__(self, path):
+        self.path = path
+        self.hash = hashlib.sha256()
+        self.fd = None
+        self.size = 0
+
+    def begin(self, size, extents):
+        self.size = size
+        self.fd = os.open(self.path, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0644)
+
+    def data(self, offset, buf, zero):
+        if not zero:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            os.write(self.fd, buf)
+        self.hash.update(buf)
+
+    def hole(self, offset, length):
+        hashZeros(self.hash, length)
+
+    def geometry(self):
+        # CHS calculation from the VHD specification
+        totalSectors = min(self.size / 512, 65535 * 16 * 255)
+        if totalSectors >= 65535 * 16 * 63:
+            sectorsPerTrack = 255
+            heads = 16
+            cylinderTimesHeads = totalSectors / sectorsPerTrack
+        else:
+            sectorsPerTrack = 17
+            cylinderTimesHeads = totalSectors / sectorsPerTrack
+            heads = max((cylinderTimesHeads + 1023) / 1024, 4)
+            if cylinderTimesHeads >= heads * 1024 or heads > 16:
+                sectorsPerTrack = 31
+                heads = 16
+                cylinderTimesHeads = totalSectors / sectorsPerTrack
+            if cylinderTimesHeads >= heads * 1024:
+                sectorsPerTrack = 63
+                heads = 16
+                cylinderTimesHeads = totalSectors / sectorsPerTrack
+        return cylinderTimesHeads / heads, heads, sectorsPerTrack
+
+    def footer(self):
+        cylinders, heads, sectorsPerTrack = self.geometry()
+        # VHD timestamps count from 2000-01-01 00:00:00 UTC
+        timestamp = int(time.time()) - 946684800
+        fields = ['conectix', 2, 0x00010000, 0xffffffffffffffff,
+                  timestamp, 'flim', 0x00010000, 'Wi2k',
+                  self.size, self.size,
+                  cylinders, heads, sectorsPerTrack,
+                  2, # fixed disk
+                  0, uuid.uuid4().bytes, 0, '\0' * 427]
+        fmt = '>8sIIQI4sI4sQQHBBII16sB427s'
+        footer = struct.pack(fmt, *fields)
+        fields[14] = ~sum(ord(x) for x in footer) & 0xffffffff
+        return struct.pack(fmt, *fields)
+
+    def end(self):
+        footer = self.footer()
+        os.ftruncate(self.fd, self.size)
+        os.lseek(self.fd, self.size, os.SEEK_SET)
+        os.write(self.fd, footer)
+        os.close(self.fd)
+        self.hash.update(footer)
+
+
+class Qcow2Artifact(object):
+    # Laid out as header, L1 table, refcount table, refcount blocks,
+    # L2 tables and then data clusters in guest order, so the whole
+    # file is written sequentially.  The layout has to be known before
+    # any data is read, so every cluster in a data extent is allocated,
+    # even if it turns out to contain only zeros.
+    COPIED = 1 << 63
+
+    def __init__(self, path):
+        self.path = path
+        self.hash = hashlib.sha256()
+        self.f = None
+
+    def write(self, data):
+        self.f.write(data)
+        self.hash.update(data)
+
+    def begin(self, size, extents):
+        clusters = []
+        for start, end in extents:
+            clusters.extend(range(start / BLOCK, ceilDiv(end, BLOCK)))
+        l2Entries = BLOCK / 8
+        l1Size = ceilDiv(size, BLOCK * l2Entries)
+        l1Clusters = ceilDiv(l1Size * 8, BLOCK)
+        l2Indices = sorted(set(x / l2Entries for x in clusters))
+
+        # refcount blocks have to count themselves
+        refcountBlocks = refcountTableClusters = 1
+        while True:
+            total = (1 + l1Clusters + refcountTableClusters + refcountBlocks
+                     + len(l2Indices) + len(clusters))
+            needBlocks = ceilDiv(total, BLOCK / 2)
+            needTable = ceilDiv(needBlocks * 8, BLOCK)
+            if (needBlocks, needTable) == (refcountBlocks,
+                                           refcountTableClusters):
+                break
+            refcountBlocks, refcountTableClusters = needBlocks, needTable
+
+        l1Offset = BLOCK
+        refcountTableOffset = l1Offset + l1Clusters * BLOCK
+        refcountBlockOffset = (refcountTableOffset
+                               + refcountTableClusters * BLOCK)
+        l2Offset = refcountBlockOffset + refcountBlocks * BLOCK
+        dataOffset = l2Offset + len(l2Indices) * BLOCK
+
+        self.f = file(self.path, 'wb')
+        header = struct.pack('>4sIQIIQIIQQIIQ', 'QFI\xfb', 2, 0, 0, 16,
+                             size, 0, l1Size, l1Offset,
+                             refcountTableOffset, refcountTableClusters,
+                             0, 0)
+        self.write(header + '\0' * (BLOCK - len(header)))
+
+        l1 = [0] * (l1Clusters * l2Entries)
+        for i, index in enumerate(l2Indices):
+            l1[index] = (l2Offset + i * BLOCK) | self.COPIED
+        self.write(struct.pack('>%dQ' % len(l1), *l1))
+
+        refcountTable = [0] * (refcountTableClusters * l2Entries)
+        for i in range(refcountBlocks):
+            refcountTable[i] = refcountBlockOffset + i * BLOCK
+        self.write(struct.pack('>%dQ' % len(refcountTable), *refcountTable))
+
+        self.write('\0\1' * total
+                   + '\0\0' * (refcountBlocks * BLOCK / 2 - total))
+
+        l2Tables = dict((index, [0] * l2Entries) for index in l2Indices)
+        for i, cluster in enumerate(clusters):
+            l2Tables[cluster / l2Entries][cluster % l2Entries] = (
+                (dataOffset + i * BLOCK) | self.COPIED)
+        for index in l2Indices:
+            self.write(struct.pack('>%dQ' % l2Entries, *l2Tables[index]))
+
+    def data(self, offset, buf, zero):
+        if len(buf) < BLOCK:
+            buf += '\0' * (BLOCK - len(buf))
+        self.write(buf)
+
+    def hole(self, offset, length):
+        pass
+
+    def end(self):
+        self.f.close()
+
+
+artifactTypes = {
+    'raw': RawArtifact,
+    'qcow2': Qcow2Artifact,
+    'vhd': VhdArtifact,
+}
+
+
+def readAt(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    chunks = []
+    while length > 0:
+        chunk = os.read(fd, length)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+
+def copyRange(source, sourceOffset, destination, destinationOffset, length):
+    # copies length bytes of source into destination, an existing file
+    # of zeros, reading only the data extents of source and writing
+    # only blocks that are not all zeros, so that both stay sparse
+    src = os.open(source, os.O_RDONLY)
+    try:
+        dst = os.open(destination, os.O_WRONLY)
+        try:
+            end = sourceOffset + length
+            for start, stop in dataExtents(src, os.fstat(src).st_size):
+                offset = max(start, sourceOffset)
+                stop = min(stop, end)
+                while offset < stop:
+                    buf = readAt(src, offset, min(READSIZE, stop - offset))
+                    if not buf:
+                        raise IOError('unexpected end of %s at %d' %(
+                                      source, offset))
+                    for i in range(0, len(buf), BLOCK):
+                        block = buf[i:i+BLOCK]
+                        if block != ZEROS[:len(block)]:
+                            os.lseek(dst, destinationOffset + offset + i
+                                     - sourceOffset, os.SEEK_SET)
+                            os.write(dst, block)
+                    offset += len(buf)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+
+def exportImage(image, artifacts):
+    # reads image once, feeding every artifact; returns the sha256
+    # hex digest of each artifact in order
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        extents = dataExtents(fd, size)
+        for artifact in artifacts:
+            artifact.begin(size, extents)
+        position = 0
+        for start, end in extents:
+            if start > position:
+                for artifact in artifacts:
+                    artifact.hole(position, start - position)
+            offset = start
+            while offset < end:
+                buf = readAt(fd, offset, min(READSIZE, end - offset))
+                if not buf:
+                    raise IOError('unexpected end of %s at %d' %(image, offset))
+                for i in range(0, len(buf), BLOCK):
+                    block = buf[i:i+BLOCK]
+                    zero = block == ZEROS[:len(block)]
+                    for artifact in artifacts:
+                        artifact.data(offset + i, block, zero)
+                offset += len(buf)
+            position = end
+        if position < size:
+            for artifact in artifacts:
+                artifact.hole(position, size - position)
+        for artifact in artifacts:
+            artifact.end()
+    finally:
+        os.close(fd)
+    return [x.hash.hexdigest() for x in artifacts]
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# stores initrds built by dracut, and the files depmod writes in the
+# module tree, by the hash of everything they are built from: the
+# kernel version, the contents of /lib/modules/<kver> and its
+# System.map, the dracut configuration, the other configuration in
+# /etc that dracut reads and the dracut version.  On a hit the cached
+# files are copied into the image instead of running depmod and dracut.
+#
+# The programs and libraries dracut copies into the initrd from /usr,
+# /lib, /bin and /sbin are not part of the key, as hashing them would
+# take longer than running dracut.  The cache is therefore only used
+# when it is asked for, by builds that share those as well as the
+# kernel.
+#
+# The cache directory is laid out as described in
+# imagebuilder/cachedir.py, like that of the snapshot cache.
+
+import hashlib
+import os
+import shutil
+
+from imagebuilder.cachedir import CacheDirectory
+
+# files at the top of the module tree that depmod reads; other
+# modules.* files there are depmod output
+depmodInputs = ('modules.order', 'modules.builtin', 'modules.builtin.modinfo')
+
+dracutConfigs = ('/etc/dracut.conf', '/etc/dracut.conf.d')
+
+# other configuration dracut reads or copies into the initrd
+otherConfigs = ('/etc/sysconfig', '/etc/modprobe.d', '/etc/modprobe.conf',
+                '/etc/udev', '/etc/ld.so.conf', '/etc/ld.so.conf.d',
+                '/etc/ld.so.cache', '/etc/fstab', '/etc/passwd',
+                '/etc/group', '/etc/localtime')
+
+# everything dracut reads from the image besides /boot
+dracutReads = (('/lib', '/lib64', '/usr', '/bin', '/sbin') +
+               dracutConfigs + otherConfigs)
+
+# dracut-version.sh moved with dracut's library directory; the dracut
+# script itself is used when neither exists
+dracutVersions = ('/usr/lib/dracut/dracut-version.sh',
+                  '/usr/share/dracut/dracut-version.sh',
+                  '/sbin/dracut', '/usr/bin/dracut')
+
+
+def isDepmodOutput(name):
+    return name.startswith('modules.') and name not in depmodInputs
+
+
+def hashFile(h, path):
+    f = file(path)
+    while True:
+        data = f.read(1024 * 1024)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+
+
+def hashTree(h, top, exclude=None):
+    # names, types, link targets and contents, in a stable order
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, top)
+        for name in sorted(dirnames + filenames):
+            if relpath == '.' and exclude and exclude(name):
+                continue
+            path = os.path.join(dirpath, name)
+            h.update('\0%s/%s\0' % (relpath, name))
+            if os.path.islink(path):
+                h.update('l' + os.readlink(path))
+            elif os.path.isfile(path):
+                h.update('f%o\0' % (os.lstat(path).st_mode & 07777))
+                hashFile(h, path)
+            elif os.path.isdir(path):
+                h.update('d')
+
+
+def hashConfig(h, rootdir, config):
+    path = rootdir + config
+    h.update('\0%s\0' % config)
+    if os.path.isdir(path):
+        hashTree(h, path)
+    elif os.path.exists(path):
+        hashFile(h, path)
+
+
+def inputsHash(rootdir, kver):
+    # everything the initrd and depmod output are built from
+    h = hashlib.sha1(os.uname()[4] + '\0' + kver)
+    moduleDir = '%s/lib/modules/%s' % (rootdir, kver)
+    hashTree(h, moduleDir, exclude=isDepmodOutput)
+    systemMap = '%s/boot/System.map-%s' % (rootdir, kver)
+    if os.path.exists(systemMap):
+        h.update('\0System.map\0')
+        hashFile(h, systemMap)
+    for config in dracutConfigs + otherConfigs:
+        hashConfig(h, rootdir, config)
+    for version in dracutVersions:
+        path = rootdir + version
+        if os.path.exists(path):
+            h.update('\0%s\0' % version)
+            hashFile(h, path)
+            break
+    return h.hexdigest()
+
+
+class InitrdCache(CacheDirectory):
+    def __init__(self, directory, maxSize=None):
+        CacheDirectory.__init__(self, directory, maxSize)
+        self.hash = None
+        self.entry = None
+        self.result = None
+
+    def key(self, rootdir, kver):
+        self.hash = inputsHash(rootdir, kver)
+        self.entry = '/'.join((self.dir, self.hash))
+        return self.hash
+
+    def exists(self):
+        return self.entryExists(self.entry)
+
+    def touch(self):
+        self.touchEntry(self.entry)
+
+    def restore(self, rootdir, kver):
+        # returns True if the initrd and depmod output were installed
+        with self.lockedEntry(self.entry) as present:
+            if not present:
+                self.result = 'miss'
+                return False
+            moduleDir = '%s/lib/modules/%s' % (rootdir, kver)
+            for name in os.listdir(self.entry + '/modules'):
+                shutil.copy2('/'.join((self.entry, 'modules', name)),
+                             '/'.join((moduleDir, name)))
+            shutil.copy2(self.entry + '/initrd',
+                         '%s/boot/initrd-%s' % (rootdir, kver))
+            self.touch()
+        self.result = 'hit'
+        return True
+
+    def moduleState(self, rootdir, kver):
+        # used to find which files depmod wrote
+        moduleDir = '%s/lib/modules/%s' % (rootdir, kver)
+        state = {}
+        for name in os.listdir(moduleDir):
+            if isDepmodOutput(name):
+                st = os.lstat('/'.join((moduleDir, name)))
+                state[name] = (st.st_size, st.st_mtime, st.st_ino)
+        return state
+
+    def store(self, rootdir, kver, before):
+        if self.exists():
+            self.touch()
+            return
+        moduleDir = '%s/lib/modules/%s' % (rootdir, kver)
+        after = self.moduleState(rootdir, kver)
+        def fill(tmpEntry):
+            os.mkdir(tmpEntry + '/modules', 0755)
+            for name, state in after.items():
+                if before.get(name) != state:
+                    shutil.copy2('/'.join((moduleDir, name)),
+                                 '/'.join((tmpEntry, 'modules', name)))
+            shutil.copy2('%s/boot/initrd-%s' % (rootdir, kver),
+                         tmpEntry + '/initrd')
+        self.publish(self.entry, fill, prefix='.initrd.')
+        self.evict((self.entry,))
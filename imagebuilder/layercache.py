@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# stores pre-image and post-image archives extracted into directories
+# named by the hash of the archive, so that archives that do not change
+# between builds are copied into the image instead of being decompressed
+# and extracted every time.  Layers are copied with reflinks where the
+# filesystem supports them (for example a --staging directory on the
+# same btrfs or xfs filesystem as the cache), and otherwise copied.
+# They are never hardlinked into the image, because post-scripts, tag
+# handlers and password conversion change files in place, which would
+# change the cached layer too.  The cache directory is laid out as
+# described in imagebuilder/cachedir.py.
+
+import os
+
+from plumbum.cmd import cp, tar
+
+from imagebuilder import archives
+from imagebuilder.cachedir import CacheDirectory
+from imagebuilder.snapshot import fileHash
+
+
+class LayerCache(CacheDirectory):
+    def __init__(self, directory, maxSize=None):
+        CacheDirectory.__init__(self, directory, maxSize)
+        # entries used by this build, which are not evicted
+        self.using = set()
+        # archive -> entry, so that each archive is hashed once
+        self.archiveEntries = {}
+
+    def entry(self, archive):
+        # the layer does not depend on the prefix it is laid down at,
+        # so archives installed at different prefixes share a layer
+        if archive not in self.archiveEntries:
+            self.archiveEntries[archive] = '/'.join((self.dir,
+                                                     fileHash(archive)))
+        return self.archiveEntries[archive]
+
+    def layer(self, IB, archive):
+        # returns the directory holding the extracted archive,
+        # extracting it into the cache if it is not there already
+        entry = self.entry(archive)
+        self.using.add(entry)
+        if self.entryExists(entry):
+            self.touchEntry(entry)
+            return entry + '/root'
+        def fill(tmpEntry):
+            os.mkdir(tmpEntry + '/root', 0755)
+            extract = tar['-C', tmpEntry + '/root', '-x']
+            decompressor = IB.decompressor(archive)
+            with IB.resource('cpu'):
+                if decompressor is None:
+                    IB.run(extract[('-f', archive)
+                                   + archives.extractOptions])
+                else:
+                    IB.run(decompressor[archive]
+                           | extract[('-f', '-') + archives.extractOptions])
+        self.publish(entry, fill, prefix='.layer.')
+        # never evict layers this build still has to install
+        self.evict(self.using)
+        return entry + '/root'
+
+    def install(self, IB, archive, basedir):
+        # another build may evict the layer before it is locked, in
+        # which case it is extracted again
+        while True:
+            layer = self.layer(IB, archive)
+            with self.lockedEntry(self.entry(archive)) as present:
+                if not present:
+                    continue
+                # copy the contents rather than the layer directory
+                # itself, so that basedir keeps its own mode and times
+                contents = ['/'.join((layer, x))
+                            for x in sorted(os.listdir(layer))]
+                if contents:
+                    with IB.resource('io'):
+                        IB.run(cp[('-a', '--reflink=auto') + tuple(contents)
+                                  + (basedir.rstrip('/') + '/',)])
+                return
@@ -18,29 +18,175 @@
 # stores copies of modelcache files by the hash of the system model
 # used to create them.  Especially useful for caching dependency
 # resolution results
+#
+# The cache directory may be shared by concurrent builders: entries
+# are published by renaming complete temporary files into place while
+# holding an exclusive lock on the directory's .lock file, each entry
+# has a .sha256 file that is checked before the entry is used, and
+# the mtime of each entry records its last use for LRU eviction.
 
+import contextlib
+import errno
+import fcntl
 import hashlib
+import json
 import os
-import shutil
+import tempfile
+import time
+
+
+def modelHash(modeltext):
+    # include personality because personality can affect the
+    # contents of the model file
+    return hashlib.sha1(os.uname()[4] + modeltext).hexdigest()
+
 
 class ModelCacheCache(object):
-    def __init__(self, directory, modeltext, targetroot):
+    def __init__(self, directory, modeltext, targetroot,
+                 maxBytes=None, maxEntries=None):
         self.dir = directory
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
         self.targetfile = targetroot + '/var/lib/conarydb/modelcache'
-        # include personality because personality can affect the
-        # contents of the model file
-        self.hash = hashlib.sha1(os.uname()[4] + modeltext).hexdigest()
+        self.hash = modelHash(modeltext)
         self.hashfile = '/'.join((self.dir, self.hash))
+        self.sumfile = self.hashfile + '.sha256'
+        self.lockfile = '/'.join((self.dir, '.lock'))
+        self.statsfile = '/'.join((self.dir, '.stats'))
+        self.result = None
+
+    @contextlib.contextmanager
+    def locked(self, operation):
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        f = file(self.lockfile, 'a')
+        try:
+            fcntl.flock(f.fileno(), operation)
+            yield
+        finally:
+            f.close()
 
     def prime(self):
-        if os.path.exists(self.hashfile):
-            targetdir = os.path.dirname(self.targetfile)
-            if not os.path.exists(targetdir):
-                os.makedirs(targetdir)
-            shutil.copy(self.hashfile, self.targetfile)
+        with self.locked(fcntl.LOCK_SH):
+            self.result = self._prime()
+        with self.locked(fcntl.LOCK_EX):
+            if self.result == 'corrupt':
+                self._remove(self.hashfile)
+            self._count(self.result)
+        return self.result == 'hit'
+
+    def _prime(self):
+        if not os.path.exists(self.hashfile) or not os.path.exists(self.sumfile):
+            return 'miss'
+        targetdir = os.path.dirname(self.targetfile)
+        if not os.path.exists(targetdir):
+            os.makedirs(targetdir)
+        # verify while copying, so that a bad entry is never primed
+        h = hashlib.sha256()
+        fd, tmpname = tempfile.mkstemp(prefix='.modelcache.', dir=targetdir)
+        try:
+            os.fchmod(fd, 0644)
+            src = file(self.hashfile)
+            while True:
+                data = src.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+                os.write(fd, data)
+            src.close()
+            os.close(fd)
+            if h.hexdigest() != file(self.sumfile).read().strip():
+                os.unlink(tmpname)
+                return 'corrupt'
+            os.rename(tmpname, self.targetfile)
+        except:
+            os.unlink(tmpname)
+            raise
+        # record use for LRU eviction
+        now = time.time()
+        os.utime(self.hashfile, (now, now))
+        return 'hit'
 
     def store(self):
-        if not os.path.exists(self.hashfile):
-            if not os.path.exists(self.dir):
-                os.makedirs(self.dir)
-            shutil.copy(self.targetfile, self.hashfile)
+        if not os.path.exists(self.targetfile):
+            return
+        with self.locked(fcntl.LOCK_EX):
+            if (os.path.exists(self.hashfile)
+                and os.path.exists(self.sumfile)):
+                return
+            data = file(self.targetfile).read()
+            for name, contents in (
+                    (self.sumfile, hashlib.sha256(data).hexdigest() + '\n'),
+                    (self.hashfile, data)):
+                fd, tmpname = tempfile.mkstemp(prefix='.tmp.', dir=self.dir)
+                try:
+                    os.fchmod(fd, 0644)
+                    os.write(fd, contents)
+                    os.fsync(fd)
+                    os.close(fd)
+                    os.rename(tmpname, name)
+                except:
+                    os.unlink(tmpname)
+                    raise
+            self._evict()
+
+    def _remove(self, hashfile):
+        for name in (hashfile, hashfile + '.sha256'):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.dir):
+            if name.startswith('.') or name.endswith('.sha256'):
+                continue
+            path = '/'.join((self.dir, name))
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(x[1] for x in entries)
+        count = len(entries)
+        for mtime, size, path in entries:
+            if ((self.maxBytes is None or total <= self.maxBytes) and
+                (self.maxEntries is None or count <= self.maxEntries)):
+                break
+            if path == self.hashfile:
+                continue
+            self._remove(path)
+            total -= size
+            count -= 1
+            self._count('evicted')
+
+    def _count(self, event):
+        # caller holds the exclusive lock
+        stats = self._statistics()
+        stats[event] = stats.get(event, 0) + 1
+        fd, tmpname = tempfile.mkstemp(prefix='.tmp.', dir=self.dir)
+        os.fchmod(fd, 0644)
+        os.write(fd, json.dumps(stats, sort_keys=True) + '\n')
+        os.close(fd)
+        os.rename(tmpname, self.statsfile)
+
+    def _statistics(self):
+        try:
+            return json.loads(file(self.statsfile).read())
+        except (IOError, ValueError):
+            return {}
+
+    def statistics(self):
+        # counts of hit, miss, corrupt and evicted for the directory
+        with self.locked(fcntl.LOCK_SH):
+            stats = self._statistics()
+            entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum(x[1] for x in entries)
+        return stats
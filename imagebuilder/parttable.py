@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# writes single-partition DOS and GPT partition tables directly into
+# an image file, so that no loop devices or partitioning tools are
+# needed.  The result matches what partitionImage asks parted for:
+# one bootable primary partition, which in GPT parted makes an EFI
+# System Partition, with the legacy_boot attribute added by sgdisk.
+# When a table is rewritten to resize the partition, the disk
+# signature, and in GPT the disk GUID and the partition's type, GUID,
+# attributes and name, are kept from the table already in the image.
+#
+# readLayout finds the partition again in an image built earlier, so
+# that it can be updated
+
+import os
+import struct
+import uuid
+import zlib
+
+SECTOR = 512
+
+# "EFI System", which parted sets for "set 1 boot on" in GPT
+EFI_SYSTEM_GUID = uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b')
+# attribute bit 2: legacy BIOS bootable, required by extlinux
+LEGACY_BOOT = 1 << 2
+
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+# 128 entries of 128 bytes take 32 sectors
+GPT_ENTRY_SECTORS = GPT_ENTRIES * GPT_ENTRY_SIZE / SECTOR
+
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def mbrEntry(status, partType, first, count):
+    # CHS fields are set to the "beyond CHS" marker; LBA is used
+    return struct.pack('<B3sB3sII', status, '\xfe\xff\xff',
+                       partType, '\xfe\xff\xff', first, count)
+
+
+def mbr(bootCode, signature, entry):
+    # up to 440 bytes of boot code precede the disk signature
+    return (bootCode + signature + '\0\0' + entry + '\0' * 48
+            + '\x55\xaa')
+
+
+def readBootCode(f):
+    # keep any boot code already written, so that a table can be
+    # rewritten after finishFilesystem has installed the MBR code
+    f.seek(0)
+    bootCode = f.read(440)
+    return bootCode + '\0' * (440 - len(bootCode))
+
+
+def readSignature(f):
+    # keep the disk signature of a table being rewritten, which
+    # root=PARTUUID= may refer to
+    f.seek(440)
+    signature = f.read(4)
+    f.seek(510)
+    if f.read(2) == '\x55\xaa' and signature.strip('\0'):
+        return signature
+    return os.urandom(4)
+
+
+def readGpt(f):
+    # (disk GUID, first entry) of a GPT already in the image, or None
+    f.seek(SECTOR)
+    header = f.read(92)
+    if len(header) < 92 or header[:8] != 'EFI PART':
+        return None
+    diskGuid = uuid.UUID(bytes_le=header[56:72])
+    entriesLba = struct.unpack('<Q', header[72:80])[0]
+    f.seek(entriesLba * SECTOR)
+    return diskGuid, f.read(GPT_ENTRY_SIZE)
+
+
+def writeAt(f, offset, data):
+    f.seek(offset)
+    f.write(data)
+
+
+def writeDos(path, first, last):
+    f = file(path, 'r+b')
+    writeAt(f, 0, mbr(readBootCode(f), readSignature(f),
+                      mbrEntry(0x80, 0x83, first, last - first + 1)))
+    f.close()
+
+
+def gptHeader(current, backup, entriesLba, sectors, diskGuid, entriesCrc):
+    fields = ['EFI PART', 0x00010000, 92, 0, 0,
+              current, backup,
+              # first and last usable sectors
+              2 + GPT_ENTRY_SECTORS, sectors - 2 - GPT_ENTRY_SECTORS,
+              diskGuid.bytes_le, entriesLba, GPT_ENTRIES, GPT_ENTRY_SIZE,
+              entriesCrc]
+    fmt = '<8sIIIIQQQQ16sQIII'
+    header = struct.pack(fmt, *fields)
+    fields[3] = crc32(header)
+    header = struct.pack(fmt, *fields)
+    return header + '\0' * (SECTOR - len(header))
+
+
+def writeGpt(path, first, last, sectors):
+    f = file(path, 'r+b')
+    existing = readGpt(f)
+    if existing is None:
+        diskGuid = uuid.uuid4()
+        typeGuid = EFI_SYSTEM_GUID.bytes_le
+        partGuid = uuid.uuid4().bytes_le
+        attributes = LEGACY_BOOT
+        name = u'primary'.encode('utf-16-le')
+    else:
+        diskGuid, entry = existing
+        typeGuid, partGuid, attributes, name = struct.unpack(
+            '<16s16s16xQ72s', entry)
+    entry = struct.pack('<16s16sQQQ72s', typeGuid, partGuid, first, last,
+                        attributes, name)
+    entries = entry + '\0' * (GPT_ENTRIES * GPT_ENTRY_SIZE - len(entry))
+    entriesCrc = crc32(entries)
+    backupEntriesLba = sectors - 1 - GPT_ENTRY_SECTORS
+
+    # protective MBR covering the whole disk
+    writeAt(f, 0, mbr(readBootCode(f), readSignature(f),
+                      mbrEntry(0, 0xee, 1, min(sectors - 1, 0xffffffff))))
+    writeAt(f, SECTOR, gptHeader(1, sectors - 1, 2, sectors,
+                                 diskGuid, entriesCrc))
+    writeAt(f, 2 * SECTOR, entries)
+    writeAt(f, backupEntriesLba * SECTOR, entries)
+    writeAt(f, (sectors - 1) * SECTOR,
+            gptHeader(sectors - 1, 1, backupEntriesLba, sectors,
+                      diskGuid, entriesCrc))
+    f.close()
+
+
+def readLayout(path):
+    # (gpt, first, last) sectors of the partition of an image written by
+    # partitionImage or writeDos/writeGpt, or None for a filesystem image
+    f = file(path, 'rb')
+    try:
+        # ext2/3/4 superblock magic; an unpartitioned image may still
+        # have boot code written over its first 440 bytes
+        f.seek(1024 + 56)
+        if f.read(2) == '\x53\xef':
+            return None
+        f.seek(0)
+        sector = f.read(SECTOR)
+        if sector[510:] != '\x55\xaa':
+            raise IOError('%s has neither a partition table nor an ext'
+                          ' filesystem' % path)
+        partType, first, count = struct.unpack('<4xB3xII', sector[446:462])
+        if partType != 0xee:
+            return (False, first, first + count - 1)
+        f.seek(SECTOR)
+        header = f.read(92)
+        if header[:8] != 'EFI PART':
+            raise IOError('%s has a protective MBR but no GPT' % path)
+        entriesLba = struct.unpack('<Q', header[72:80])[0]
+        f.seek(entriesLba * SECTOR)
+        first, last = struct.unpack('<32xQQ', f.read(48))
+        return (True, first, last)
+    finally:
+        f.close()
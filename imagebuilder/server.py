@@ -0,0 +1,506 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# a long-running build server.  flimage serve listens on a Unix socket
+# that only root can connect to, queues the builds submitted to it by
+# priority (highest first, then in order of submission), and runs up
+# to --jobs of them at once, each in a process forked from the server,
+# so that modules, plumbum commands and hashes of pre-image and
+# post-image archives (which key the snapshot and layer caches) are
+# loaded or computed once instead of for every build.
+#
+# Each of the --jobs slots has its own loop device, set up when the
+# server starts, and optionally its own staging directory under
+# --staging-dir for builds that do not name one.  The output of each
+# build is written to LOGDIR/ID.log and streamed to the client that
+# submitted it.
+#
+# Requests and replies are single lines of JSON.  A client sends
+#
+#   {"command": "build", "argv": [FLIMAGE ARGUMENTS], "priority": 0}
+#   {"command": "build", "spec": {BATCH IMAGE ENTRY}, "workdir": DIR}
+#   {"command": "status"}
+#
+# and for builds receives "queued", "started" and "log" events and a
+# final "done" event with the status of the build, unless it asked to
+# "detach" after "queued".
+#
+# usage: flimage serve [-S SOCKET] [-j JOBS] [--staging-dir DIR] ...
+#        flimage submit [-S SOCKET] [-p PRIORITY] [--detach] -- ARGUMENTS
+#        flimage submit --status
+
+import argparse
+import fcntl
+import heapq
+import json
+import multiprocessing
+import os
+import Queue
+import socket
+import stat
+import sys
+import threading
+import time
+
+from imagebuilder import archives
+from imagebuilder import batch
+from imagebuilder import snapshot
+
+defaultSocket = '/run/flimage.sock'
+
+LOOP_CTL_ADD = 0x4C80
+
+
+def freeLoopDevices(count):
+    # loop devices not attached to any file, created through
+    # /dev/loop-control if there are not enough of them
+    devices = []
+    control = None
+    index = 0
+    try:
+        while len(devices) < count:
+            name = 'loop%d' % index
+            index += 1
+            sysdir = '/sys/block/' + name
+            if not os.path.exists(sysdir):
+                if control is None:
+                    control = os.open('/dev/loop-control', os.O_RDWR)
+                fcntl.ioctl(control, LOOP_CTL_ADD, index - 1)
+            if os.path.exists(sysdir + '/loop/backing_file'):
+                continue
+            path = '/dev/' + name
+            if not os.path.exists(path):
+                # udev has not created the node yet
+                major, minor = file(sysdir + '/dev').read().split(':')
+                os.mknod(path, 0660|stat.S_IFBLK,
+                         os.makedev(int(major), int(minor)))
+            devices.append(path)
+    finally:
+        if control is not None:
+            os.close(control)
+    return devices
+
+
+def archiveArguments(argv):
+    # archives named by --pre-image and --post-image in flimage arguments
+    found = []
+    for i, arg in enumerate(argv):
+        for option in ('--pre-image', '--post-image'):
+            if arg == option and i + 1 < len(argv):
+                found.append(argv[i + 1])
+            elif arg.startswith(option + '='):
+                found.append(arg[len(option) + 1:])
+    return [archives.splitImage(x)[1] for x in found]
+
+
+def basenameArgument(argv):
+    for i, arg in enumerate(argv):
+        if arg in ('-b', '--basename') and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--basename='):
+            return arg[len('--basename='):]
+    return None
+
+
+def send(conn, message):
+    conn.sendall(json.dumps(message) + '\n')
+
+
+def runJob(builder, resources, argv, slot, fd, closeFds):
+    # in the forked build process
+    for closeFd in closeFds:
+        os.close(closeFd)
+    devnull = os.open('/dev/null', os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    # line buffered, so that progress is streamed as it happens
+    sys.stdout = os.fdopen(1, 'w', 1)
+    sys.stderr = os.fdopen(2, 'w', 1)
+    builder(argv, resources, slot['loop'], slot['staging'])
+
+
+class Job(object):
+    def __init__(self, jobId, name, argv, priority, log):
+        self.id = jobId
+        self.name = name
+        self.argv = argv
+        self.priority = priority
+        self.log = log
+        self.state = 'queued'
+        self.status = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        # a Queue.Queue for each client following the build
+        self.listeners = []
+
+    def summary(self):
+        end = self.finished or time.time()
+        return {'id': self.id, 'name': self.name, 'state': self.state,
+                'priority': self.priority, 'status': self.status,
+                'error': self.error, 'log': self.log,
+                'queued': (self.started or end) - self.submitted,
+                'elapsed': self.started and end - self.started or 0}
+
+
+class BuildServer(object):
+    def __init__(self, buildFunction, socketPath, jobs=1, cpuJobs=None,
+                 ioJobs=None, logDir='/var/log/flimage', loopDevices=(),
+                 stagingDir=None):
+        self.buildFunction = buildFunction
+        self.socketPath = socketPath
+        self.logDir = logDir
+        self.resources = {}
+        if cpuJobs:
+            self.resources['cpu'] = multiprocessing.BoundedSemaphore(cpuJobs)
+        if ioJobs:
+            self.resources['io'] = multiprocessing.BoundedSemaphore(ioJobs)
+        self.slots = []
+        for index in range(jobs):
+            staging = None
+            if stagingDir:
+                staging = '%s/slot%d' % (stagingDir, index)
+                if not os.path.exists(staging):
+                    os.makedirs(staging, 0755)
+            loop = None
+            if index < len(loopDevices):
+                loop = loopDevices[index]
+            self.slots.append({'loop': loop, 'staging': staging, 'job': None})
+        # (-priority, sequence, job)
+        self.queue = []
+        self.jobs = {}
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.listener = None
+
+    def listen(self):
+        if os.path.exists(self.socketPath):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socketPath)
+            except socket.error:
+                # left behind by a server that is no longer running
+                os.unlink(self.socketPath)
+            else:
+                raise IOError('a server is already listening on %s'
+                              % self.socketPath)
+            finally:
+                probe.close()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # builds run as root, so only root may submit them
+        umask = os.umask(077)
+        try:
+            self.listener.bind(self.socketPath)
+        finally:
+            os.umask(umask)
+        self.listener.listen(16)
+
+    def serve(self):
+        if not os.path.exists(self.logDir):
+            os.makedirs(self.logDir)
+        self.listen()
+        scheduler = threading.Thread(target=self.schedule)
+        scheduler.daemon = True
+        scheduler.start()
+        try:
+            while True:
+                conn, address = self.listener.accept()
+                handler = threading.Thread(target=self.handle, args=(conn,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            self.listener.close()
+            os.unlink(self.socketPath)
+
+    def broadcast(self, job, event):
+        event['id'] = job.id
+        with self.condition:
+            for listener in job.listeners:
+                listener.put(event)
+
+    def submit(self, request):
+        if 'spec' in request:
+            basedir, argv = batch.specArgs(request['spec'],
+                                           request.get('workdir', os.getcwd()))
+        else:
+            argv = [str(x) for x in request['argv']]
+        priority = int(request.get('priority', 0))
+        with self.condition:
+            self.sequence += 1
+            jobId = '%d' % self.sequence
+            name = basenameArgument(argv) or 'job' + jobId
+            job = Job(jobId, name, argv, priority,
+                      '%s/%s.log' % (self.logDir, jobId))
+            self.jobs[jobId] = job
+            heapq.heappush(self.queue, (-priority, self.sequence, job))
+            self.condition.notify_all()
+        return job
+
+    def status(self):
+        with self.condition:
+            return {'event': 'status',
+                    'jobs': [self.jobs[x].summary() for x in
+                             sorted(self.jobs, key=int)
+                             if self.jobs[x].state != 'done'],
+                    'slots': len(self.slots),
+                    'idle': len([x for x in self.slots if x['job'] is None])}
+
+    def handle(self, conn):
+        listener = None
+        job = None
+        try:
+            request = json.loads(conn.makefile('r').readline() or 'null')
+            if not isinstance(request, dict):
+                return
+            if request.get('command') == 'status':
+                send(conn, self.status())
+                return
+            if request.get('command') != 'build':
+                send(conn, {'event': 'error',
+                            'error': 'unknown command %r'
+                                     % request.get('command')})
+                return
+            error = None
+            with self.condition:
+                try:
+                    job = self.submit(request)
+                except KeyError, e:
+                    error = 'missing %s' % e.args[0]
+                except (ValueError, TypeError), e:
+                    error = str(e)
+                else:
+                    listener = Queue.Queue()
+                    job.listeners.append(listener)
+                    position = len([x for x in self.queue
+                                    if x[:2] <= (-job.priority, int(job.id))])
+            if error is not None:
+                send(conn, {'event': 'error',
+                            'error': 'invalid build request: %s' % error})
+                return
+            send(conn, {'event': 'queued', 'id': job.id, 'name': job.name,
+                        'position': position, 'log': job.log})
+            if request.get('detach'):
+                return
+            while True:
+                event = listener.get()
+                send(conn, event)
+                if event['event'] == 'done':
+                    break
+        except (socket.error, ValueError, KeyError):
+            # the client went away or sent a bad request; the build,
+            # if there is one, goes on
+            pass
+        finally:
+            if listener is not None:
+                with self.condition:
+                    job.listeners.remove(listener)
+            try:
+                # build processes forked while this connection was open
+                # hold it too, so close it for all of them
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+    def schedule(self):
+        while True:
+            with self.condition:
+                while True:
+                    idle = [x for x in self.slots if x['job'] is None]
+                    if idle and self.queue:
+                        break
+                    self.condition.wait()
+                priority, sequence, job = heapq.heappop(self.queue)
+                slot = idle[0]
+                slot['job'] = job
+                job.state = 'running'
+                job.started = time.time()
+            self.start(job, slot)
+
+    def start(self, job, slot):
+        # hashed here rather than in the build so that the hash is kept
+        for archive in archiveArguments(job.argv):
+            try:
+                snapshot.fileHash(archive)
+            except (IOError, OSError):
+                # reported by the build
+                pass
+        sys.stderr.write('started %s %s on %s\n' % (job.id, job.name,
+                         slot['loop'] or slot['staging'] or 'a free slot'))
+        self.broadcast(job, {'event': 'started', 'loop': slot['loop'],
+                             'staging': slot['staging']})
+        readFd, writeFd = os.pipe()
+        process = multiprocessing.Process(target=runJob,
+            args=(self.buildFunction, self.resources, job.argv, slot,
+                  writeFd, (readFd, self.listener.fileno())))
+        process.start()
+        os.close(writeFd)
+        reader = threading.Thread(target=self.follow,
+                                  args=(job, slot, process, readFd))
+        reader.daemon = True
+        reader.start()
+
+    def follow(self, job, slot, process, readFd):
+        output = os.fdopen(readFd)
+        log = file(job.log, 'w', 1)
+        lastLine = None
+        try:
+            for line in iter(output.readline, ''):
+                log.write(line)
+                line = line.rstrip('\n')
+                if line.strip():
+                    lastLine = line
+                self.broadcast(job, {'event': 'log', 'line': line})
+        finally:
+            output.close()
+            log.close()
+            process.join()
+        with self.condition:
+            job.state = 'done'
+            job.finished = time.time()
+            if process.exitcode == 0:
+                job.status = 'ok'
+            else:
+                job.status = 'failed'
+                job.error = lastLine or 'exit %s' % process.exitcode
+            slot['job'] = None
+            self.condition.notify_all()
+        sys.stderr.write('finished %s %s: %s\n' % (job.id, job.name,
+                                                    job.status))
+        done = job.summary()
+        done['event'] = 'done'
+        self.broadcast(job, done)
+
+
+def writeStatus(status, out):
+    jobs = status['jobs']
+    width = max([len(str(x['name'])) for x in jobs] + [4])
+    out.write('%-5s  %-*s  %-7s  %8s  %8s\n' % ('id', width, 'name', 'state',
+                                                'priority', 'seconds'))
+    for job in jobs:
+        out.write('%-5s  %-*s  %-7s  %8d  %8.1f\n' % (job['id'], width,
+            job['name'], job['state'], job['priority'],
+            job['elapsed'] or job['queued']))
+    out.write('%d of %d slots idle, %d queued\n' % (status['idle'],
+        status['slots'], len([x for x in jobs if x['state'] == 'queued'])))
+
+
+def submit(argv):
+    ap = argparse.ArgumentParser(prog='flimage submit',
+                                 description='Submit a build to flimage serve')
+    ap.add_argument('-S', '--socket', default=defaultSocket,
+                    help='server socket [%s]' % defaultSocket)
+    ap.add_argument('-p', '--priority', type=int, default=0,
+                    help='builds with higher priority start first [0]')
+    ap.add_argument('--detach',
+                    action='store_true', default=False,
+                    help='return once the build is queued')
+    ap.add_argument('--status',
+                    action='store_true', default=False,
+                    help='show queued and running builds')
+    ap.add_argument('arguments', nargs=argparse.REMAINDER,
+                    help='flimage arguments for the build')
+    args = ap.parse_args(argv)
+    arguments = args.arguments
+    if arguments and arguments[0] == '--':
+        arguments = arguments[1:]
+    if args.status:
+        request = {'command': 'status'}
+    elif arguments:
+        request = {'command': 'build', 'argv': arguments,
+                   'priority': args.priority, 'detach': args.detach}
+    else:
+        ap.error('no build arguments given')
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(args.socket)
+    except socket.error, e:
+        sys.stderr.write('flimage submit: %s: %s\n' % (args.socket, e))
+        return 1
+    send(conn, request)
+    replies = conn.makefile('r')
+    status = 1
+    for line in iter(replies.readline, ''):
+        event = json.loads(line)
+        if event['event'] == 'status':
+            writeStatus(event, sys.stdout)
+            status = 0
+        elif event['event'] == 'queued':
+            sys.stderr.write('queued %s as %s, position %d, log %s\n' % (
+                event['name'], event['id'], event['position'], event['log']))
+            if args.detach:
+                status = 0
+        elif event['event'] == 'log':
+            sys.stdout.write(event['line'] + '\n')
+            sys.stdout.flush()
+        elif event['event'] == 'done':
+            sys.stderr.write('%s %s in %.1f seconds%s\n' % (event['name'],
+                event['status'], event['elapsed'],
+                event['error'] and ': ' + event['error'] or ''))
+            if event['status'] == 'ok':
+                status = 0
+        elif event['event'] == 'error':
+            sys.stderr.write('flimage submit: %s\n' % event['error'])
+    conn.close()
+    return status
+
+
+def main(argv, buildFunction):
+    ap = argparse.ArgumentParser(prog='flimage serve',
+                                 description='Run builds submitted with'
+                                 ' flimage submit')
+    ap.add_argument('-S', '--socket', default=defaultSocket,
+                    help='socket to listen on [%s]' % defaultSocket)
+    ap.add_argument('-j', '--jobs', type=int,
+                    default=multiprocessing.cpu_count(),
+                    help='number of images to build at once')
+    ap.add_argument('--cpu-jobs', type=int,
+                    help='concurrent CPU-bound steps (initrd, compression)')
+    ap.add_argument('--io-jobs', type=int,
+                    help='concurrent I/O-bound steps (sync, copy)')
+    ap.add_argument('--log-dir', default='/var/log/flimage',
+                    help='directory for build logs [/var/log/flimage]')
+    ap.add_argument('--staging-dir',
+                    help='directory (preferably tmpfs) with a staging'
+                         ' directory for each job, used by builds that'
+                         ' do not give --staging')
+    ap.add_argument('--no-loop-pool',
+                    action='store_true', default=False,
+                    help='do not set aside a loop device for each job')
+    args = ap.parse_args(argv)
+
+    loopDevices = ()
+    if not args.no_loop_pool:
+        loopDevices = freeLoopDevices(args.jobs)
+    server = BuildServer(buildFunction, args.socket, args.jobs,
+                         args.cpu_jobs, args.io_jobs, args.log_dir,
+                         loopDevices, args.staging_dir)
+    sys.stderr.write('flimage serve: %d jobs on %s\n' % (args.jobs,
+                                                         args.socket))
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    except IOError, e:
+        sys.stderr.write('flimage serve: %s\n' % e)
+        return 1
+    return 0
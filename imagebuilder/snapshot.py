@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# stores fully installed root trees (including the conary database
+# and the tag script that conary wrote) by the hash of the system
+# model and pre-images used to create them, so that repeated builds
+# of the same model do not have to run conary sync again.  The cache
+# directory is laid out as described in imagebuilder/cachedir.py.
+
+import hashlib
+import os
+import shutil
+
+from plumbum.cmd import tar
+
+from imagebuilder.cachedir import CacheDirectory
+
+# contents of these directories are mounted filesystems or scratch
+# space in the image, not part of the installed system
+excludes = ('./proc/*', './sys/*', './dev/pts/*', './dev/shm/*',
+            './tmp/*', './var/tmp/*')
+
+
+# hashes by path and file identity, so that a long-running process
+# (flimage serve) hashes each version of an archive once
+fileHashes = {}
+
+def fileHash(path):
+    st = os.stat(path)
+    key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    if key in fileHashes:
+        return fileHashes[key]
+    h = hashlib.sha1()
+    f = file(path)
+    while True:
+        data = f.read(1024 * 1024)
+        if not data:
+            break
+        h.update(data)
+    fileHashes[key] = h.hexdigest()
+    return fileHashes[key]
+
+
+class SnapshotCache(CacheDirectory):
+    def __init__(self, directory, modeltext, preImages=None, maxSize=None):
+        CacheDirectory.__init__(self, directory, maxSize)
+        # include personality because personality can affect the
+        # contents of the model file, and pre-images because they
+        # are laid down before conary runs
+        h = hashlib.sha1(os.uname()[4] + modeltext)
+        for preImage in preImages or ():
+            prefix = '/'
+            archive = preImage
+            if ':' in preImage:
+                prefix, archive = preImage.split(':', 1)
+            h.update('\0%s\0%s' % (prefix, fileHash(archive)))
+        self.hash = h.hexdigest()
+        self.entry = '/'.join((self.dir, self.hash))
+        self.snapshotRoot = self.entry + '/root'
+        self.tagScript = self.entry + '/tag-script'
+
+    def exists(self):
+        return self.entryExists(self.entry)
+
+    def touch(self):
+        self.touchEntry(self.entry)
+
+    def restore(self, IB):
+        # returns False if another build evicted the snapshot first
+        with self.lockedEntry(self.entry) as present:
+            if not present:
+                return False
+            with IB.resource('io'):
+                IB.run(tar['-C', self.snapshotRoot, '-c', '-f', '-', '.']
+                       | tar['-C', IB.rootdir, '-x', '-p', '--numeric-owner',
+                             '-f', '-'])
+            if os.path.exists(self.tagScript):
+                shutil.copy2(self.tagScript, IB.rootdir + '/tmp/tag-script')
+            self.touch()
+        return True
+
+    def store(self, IB):
+        if self.exists():
+            self.touch()
+            return
+        def fill(tmpEntry):
+            os.mkdir(tmpEntry + '/root', 0755)
+            with IB.resource('io'):
+                IB.run(tar[('-C', IB.rootdir, '-c', '-f', '-')
+                           + tuple('--exclude=%s' % x for x in excludes)
+                           + ('.',)]
+                       | tar['-C', tmpEntry + '/root', '-x', '-p',
+                             '--numeric-owner', '-f', '-'])
+            tagScript = IB.rootdir + '/tmp/tag-script'
+            if os.path.exists(tagScript):
+                shutil.copy2(tagScript, tmpEntry + '/tag-script')
+        self.publish(self.entry, fill, prefix='.snap.')
+        # never evict the snapshot we are using
+        self.evict((self.entry,))
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# parses the tag script that conary writes with --tag-script into
+# plain commands and tag handler invocations.  Handler invocations
+# look like:
+#
+#   /usr/libexec/conary/tags/info files update << EOF
+#   /usr/share/info/foo.info.gz
+#   EOF
+#
+# Run sequentially, the script is run as conary wrote it, with ldconfig
+# moved to the start and the handlers flimage replaces removed.  To run
+# it concurrently, it is split into steps at the plain commands, which
+# are run in order, one step after another.  Within a run of handler
+# invocations, those of different handlers do not depend on one
+# another and run concurrently; those of the same handler are run in
+# order by one script, with consecutive invocations that have the same
+# action merged and their file lists combined.
+
+import re
+
+heredoc = re.compile(r'^(?P<command>.*?)\s*<<\s*[\'"]?(?P<end>\w+)[\'"]?\s*$')
+
+ldconfig = '/sbin/ldconfig'
+
+# handlers that flimage replaces with its own steps
+ignoredHandlers = (
+    '/usr/libexec/conary/tags/kernel files update',
+    '/usr/libexec/conary/tags/extlinux files update',
+    '/usr/libexec/conary/tags/udev files update',
+)
+
+
+class TagInvocation(object):
+    def __init__(self, command, end='EOF'):
+        self.command = command
+        self.end = end
+        self.files = []
+        self.seen = set()
+
+    def addFiles(self, files):
+        for name in files:
+            if name not in self.seen:
+                self.seen.add(name)
+                self.files.append(name)
+
+    def script(self):
+        return '\n'.join(['%s << %s' % (self.command, self.end)]
+                         + self.files + [self.end, ''])
+
+
+class TagHandler(object):
+    # the invocations of one handler within a step, in order
+    def __init__(self, path):
+        self.path = path
+        self.invocations = []
+
+    def add(self, command, end, files):
+        if not self.invocations or self.invocations[-1].command != command:
+            self.invocations.append(TagInvocation(command, end))
+        self.invocations[-1].addFiles(files)
+
+    def fileCount(self):
+        return sum(len(x.files) for x in self.invocations)
+
+    def script(self):
+        return ''.join(x.script() for x in self.invocations)
+
+
+class TagScript(object):
+    def __init__(self, text, ignore=ignoredHandlers):
+        # the script for sequential execution, less ldconfig
+        self.lines = []
+        # in order, lists of plain commands and lists of TagHandlers
+        # that can run concurrently, alternately
+        self.steps = [[ldconfig]]
+        handlers = None
+        lines = iter(text.split('\n'))
+        for line in lines:
+            match = heredoc.match(line)
+            if not match:
+                if line.strip() and line.strip() != ldconfig:
+                    self.lines.append(line)
+                    if handlers is not None:
+                        handlers = None
+                        self.steps.append([])
+                    self.steps[-1].append(line)
+                continue
+            command, end = match.group('command'), match.group('end')
+            files = []
+            for fileLine in lines:
+                if fileLine == end:
+                    break
+                files.append(fileLine)
+            if [x for x in ignore if command.startswith(x)]:
+                continue
+            self.lines.extend([line] + files + [end])
+            if handlers is None:
+                handlers = {}
+                self.steps.append([])
+            path = command.split()[0]
+            if path not in handlers:
+                handlers[path] = TagHandler(path)
+                self.steps[-1].append(handlers[path])
+            handlers[path].add(command, end, files)
+
+    def handlerSteps(self):
+        return [x for x in self.steps if isinstance(x[0], TagHandler)]
+
+    def script(self):
+        # the whole script for sequential execution
+        return '\n'.join([ldconfig] + self.lines + [''])
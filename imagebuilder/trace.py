@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# records wall time, CPU time, memory and I/O for build stages and
+# the commands they run.  Child figures come from getrusage and from
+# /proc/self/io, to which the kernel adds the I/O of reaped children.
+# Traces are written both as JSON lines and in the Chrome trace event
+# format (load the .json file in chrome://tracing or Perfetto)
+
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+
+def readProcIo(pid='self'):
+    counters = {}
+    try:
+        for line in file('/proc/%s/io' % pid).readlines():
+            key, value = line.split(':')
+            counters[key] = int(value)
+    except (IOError, ValueError):
+        pass
+    return counters
+
+
+class Sample(object):
+    def __init__(self):
+        self.time = time.time()
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.self = resource.getrusage(resource.RUSAGE_SELF)
+        self.io = readProcIo()
+
+
+class Tracer(object):
+    def __init__(self):
+        self.events = []
+        self.origin = time.time()
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def span(self, category, name):
+        before = Sample()
+        status = 'ok'
+        try:
+            yield
+        except:
+            status = 'failed'
+            raise
+        finally:
+            self.record(category, name, before, Sample(), status)
+
+    def stage(self, name):
+        return self.span('stage', name)
+
+    def command(self, cmd):
+        return self.span('command', str(cmd))
+
+    def record(self, category, name, before, after, status):
+        # child and I/O figures are process-wide, so they include the
+        # work of stages running concurrently in other threads
+        ioDelta = dict((key, after.io.get(key, 0) - before.io.get(key, 0))
+                       for key in after.io)
+        event = {
+            'cat': category,
+            'name': name,
+            'status': status,
+            'start': before.time - self.origin,
+            'wall': after.time - before.time,
+            'childUser': after.children.ru_utime - before.children.ru_utime,
+            'childSystem': after.children.ru_stime - before.children.ru_stime,
+            'selfCpu': (after.self.ru_utime + after.self.ru_stime
+                        - before.self.ru_utime - before.self.ru_stime),
+            # ru_maxrss is in KiB and is a high-water mark for the
+            # largest child, not a per-span figure
+            'childMaxRss': after.children.ru_maxrss,
+            'readBytes': ioDelta.get('read_bytes', 0),
+            'writeBytes': ioDelta.get('write_bytes', 0),
+            'readChars': ioDelta.get('rchar', 0),
+            'writeChars': ioDelta.get('wchar', 0),
+        }
+        thread = threading.current_thread()
+        if not isinstance(thread, threading._MainThread):
+            event['lane'] = thread.name
+        self.events.append(event)
+
+    def add(self, category, name, start, wall, status, lane=None, **fields):
+        # for work measured elsewhere, such as commands run concurrently
+        # by the chroot executor; lane separates overlapping events
+        event = {
+            'cat': category,
+            'name': name,
+            'status': status,
+            'start': start - self.origin,
+            'wall': wall,
+        }
+        if lane is not None:
+            event['lane'] = lane
+        event.update(fields)
+        self.events.append(event)
+
+    def chromeEvents(self):
+        events = []
+        for event in self.events:
+            args = dict(event)
+            for key in ('cat', 'name', 'start', 'wall', 'lane'):
+                args.pop(key, None)
+            events.append({
+                'name': event['name'],
+                'cat': event['cat'],
+                'ph': 'X',
+                'ts': int(event['start'] * 1000000),
+                'dur': int(event['wall'] * 1000000),
+                'pid': self.pid,
+                'tid': event.get('lane', self.pid),
+                'args': args,
+            })
+        return events
+
+    def write(self, path):
+        f = file(path + '.jsonl', 'w')
+        for event in self.events:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+        f.close()
+        file(path + '.json', 'w').write(json.dumps(
+            {'traceEvents': self.chromeEvents(),
+             'displayTimeUnit': 'ms'}) + '\n')
+
+
+class NullTracer(object):
+    # used when no trace was requested
+
+    @contextlib.contextmanager
+    def span(self, category, name):
+        yield
+
+    def stage(self, name):
+        return self.span('stage', name)
+
+    def command(self, cmd):
+        return self.span('command', cmd)
+
+    def add(self, category, name, start, wall, status, lane=None, **fields):
+        pass
+
+    def write(self, path):
+        pass
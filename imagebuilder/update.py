@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Michael K Johnson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+# decides which steps of a build an update (flimage update) has to
+# run again after "conary sync" has moved an image built earlier to a
+# new system model.  Before the sync, record() notes in the
+# ImageBuilder what the boot steps read: the installed kernels, the
+# hash of the initrd's inputs as the initrd cache computes it, the
+# state of the programs and libraries dracut copies into the initrd,
+# and the kernels, initrds and bootloader configuration bootman
+# reads.  Each boot step then compares its inputs with those noted and
+# is skipped when they are unchanged.  Tag handlers need no such test:
+# conary writes only the handlers for the files the sync changed into
+# the tag script, and none at all if there are none.
+#
+# The state is kept in ImageBuilder.updateState, so that it is saved
+# in checkpoints with the rest of the build's state.
+
+import hashlib
+import os
+import re
+
+from plumbum.cmd import conary
+
+from imagebuilder import initrdcache
+
+# read by bootman, besides the files in /etc/bootloader.d
+bootmanReads = ('/etc/bootloader.conf',)
+bootPrefixes = ('vmlinuz-', 'initrd-', 'System.map-')
+
+
+def kernels(rootdir):
+    moduleDir = rootdir + '/lib/modules'
+    if not os.path.isdir(moduleDir):
+        return []
+    return sorted(os.listdir(moduleDir))
+
+
+def defaultKernel(rootdir):
+    # the kernel createBootloaderConf chose when the image was built
+    conf = rootdir + '/etc/bootloader.conf'
+    if os.path.exists(conf):
+        for line in file(conf):
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == 'default':
+                return fields[1]
+    installed = kernels(rootdir)
+    if installed:
+        return installed[0]
+    return None
+
+
+def bootFiles(rootdir):
+    # size and modification time of everything bootman reads; lists
+    # rather than tuples, to compare equal after a checkpoint
+    paths = list(bootmanReads)
+    if os.path.isdir(rootdir + '/boot'):
+        paths.extend('/boot/' + x for x in os.listdir(rootdir + '/boot')
+                     if x.startswith(bootPrefixes))
+    if os.path.isdir(rootdir + '/etc/bootloader.d'):
+        paths.extend('/etc/bootloader.d/' + x
+                     for x in os.listdir(rootdir + '/etc/bootloader.d'))
+    files = {}
+    for path in paths:
+        if os.path.lexists(rootdir + path):
+            st = os.lstat(rootdir + path)
+            files[path] = [st.st_size, int(st.st_mtime)]
+    return files
+
+
+def initrdInputs(rootdir, kver):
+    if kver is None or not os.path.isdir(
+            '%s/lib/modules/%s' % (rootdir, kver)):
+        return None
+    return initrdcache.inputsHash(rootdir, kver)
+
+
+def systemState(rootdir):
+    # the initrd cache key leaves out what dracut reads outside the
+    # module tree and /etc; a sync that replaces any of it changes its
+    # type, size, modification time or inode
+    h = hashlib.sha1()
+    modules = ('%s/lib/modules' % rootdir, '%s/usr/lib/modules' % rootdir)
+    def stamp(path):
+        st = os.lstat(path)
+        h.update('\0%s\0%o %d %d %d' % (path[len(rootdir):], st.st_mode,
+                                         st.st_size, int(st.st_mtime),
+                                         st.st_ino))
+    for top in initrdcache.dracutReads:
+        path = rootdir + top
+        if top.startswith('/etc/') or not os.path.lexists(path):
+            continue
+        stamp(path)
+        if os.path.islink(path):
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(x for x in dirnames
+                                 if os.path.join(dirpath, x) not in modules)
+            for name in sorted(dirnames + filenames):
+                stamp(os.path.join(dirpath, name))
+    return h.hexdigest()
+
+
+def record(IB):
+    IB.kver = defaultKernel(IB.rootdir)
+    IB.updateState = {
+        'kver': IB.kver,
+        'kernels': kernels(IB.rootdir),
+        'initrd': initrdInputs(IB.rootdir, IB.kver),
+        'system': systemState(IB.rootdir),
+        'boot': bootFiles(IB.rootdir),
+    }
+
+
+def newKernel(IB):
+    # the kernel the sync installed, or None if the kernels are unchanged
+    before = IB.updateState['kernels']
+    after = kernels(IB.rootdir)
+    if after == before and IB.kver in after:
+        return None
+    added = [x for x in after if x not in before]
+    if added:
+        return added[-1]
+    return after[0]
+
+
+def initrdChanged(IB):
+    state = IB.updateState
+    if IB.kver != state['kver']:
+        return True
+    if not os.path.exists('%s/boot/initrd-%s' % (IB.rootdir, IB.kver)):
+        return True
+    if initrdInputs(IB.rootdir, IB.kver) != state['initrd']:
+        return True
+    return systemState(IB.rootdir) != state.get('system')
+
+
+def bootChanged(IB):
+    return bootFiles(IB.rootdir) != IB.updateState['boot']
+
+
+def latestRollback(IB):
+    # the rollback the sync created; builds remove their rollbacks, so
+    # it is usually the only one
+    output = IB.run(conary['rblist', '--root', IB.rootdir])
+    numbers = [int(x) for x in re.findall(r'^\s*r\.(\d+):', output, re.M)]
+    if not numbers:
+        return None
+    return 'r.%d' % max(numbers)